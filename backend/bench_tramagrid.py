@@ -0,0 +1,251 @@
+# filename: bench_tramagrid.py
+"""Benchmark offline das operações de TramaGridSession.
+
+Roda com imagens sintéticas, sem Supabase/Stripe (as chaves são zeradas antes do import)
+e com DATA_DIR num diretório temporário. Para cada combinação de largura da grade,
+max_colors e cell_size mede as operações quentes e grava percentis de latência, pico de
+memória e blocos alocados (tracemalloc) em JSON.
+
+    python bench_tramagrid.py                          # matriz completa -> bench_results.json
+    python bench_tramagrid.py --quick                  # rodada curta (1 configuração)
+    python bench_tramagrid.py --widths 130 --colors 16 --cell-sizes 22 --repeat 20
+    python bench_tramagrid.py --baseline base.json     # compara com uma rodada anterior
+
+Na comparação, o processo sai com código 1 se alguma operação ficar mais lenta que a base
+além de --tolerance (fração) e de --min-ms (ms), servindo de checagem antes do deploy.
+Obs.: os buffers de pixels do Pillow não passam pelo tracemalloc; peak_kib/net_blocks cobrem
+Python e NumPy, e rss_peak_kib (pico de RSS acima do RSS inicial) cobre o processo inteiro.
+No Linux o pico é zerado antes de cada operação (/proc/self/clear_refs); em outros sistemas
+vale o crescimento de ru_maxrss, que só registra novos máximos do processo.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import ctypes
+import ctypes.util
+import gc
+import platform
+import resource
+import tempfile
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+OPS = [
+    "generate_grid", "grid_layers_cold", "_draw_grid", "_draw_grid[no_grid]",
+    "paint_cell", "undo[paint]", "merge_colors", "undo[merge]", "delete_color",
+    "replace_index_in_region", "get_palette_info", "get_grid_base64",
+    "save_to_disk", "load_from_disk", "reopen[grid_image]",
+]
+
+
+def synthetic_image(w: int = 1600, h: int = 1200, seed: int = 0) -> Image.Image:
+    # Gradientes suaves + discos de cor chapada + ruído: parecido com uma foto para o quantizador
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:h, 0:w] / max(w, h)
+    img = np.stack([128 + 127 * np.sin(6 * x + 2 * y), 128 + 127 * np.cos(4 * y - 3 * x), 255 * x * y], axis=-1)
+    for _ in range(40):
+        cx, cy, r = rng.random(), rng.random() * h / w, 0.02 + 0.08 * rng.random()
+        img[(x - cx) ** 2 + (y - cy) ** 2 < r ** 2] = rng.integers(0, 256, 3)
+    img += rng.normal(0, 8, img.shape)
+    return Image.fromarray(np.clip(img, 0, 255).astype(np.uint8))
+
+
+def _rss_status() -> Optional[Tuple[int, int]]:
+    # (RSS atual, pico desde o último reset) em KiB, lidos de /proc/self/status
+    try:
+        with open("/proc/self/status") as f: vals = dict(l.split(":", 1) for l in f if l.startswith(("VmRSS", "VmHWM")))
+        return int(vals["VmRSS"].split()[0]), int(vals["VmHWM"].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def _release_free_memory() -> None:
+    # Sem isso o glibc mantém residentes os buffers já liberados e a operação reaproveita essas
+    # páginas: o pico acima do RSS inicial sairia ~0 mesmo alocando dezenas de MB
+    gc.collect()
+    try: ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError): pass
+
+def _reset_rss_peak() -> bool:
+    _release_free_memory()
+    try:
+        with open("/proc/self/clear_refs", "w") as f: f.write("5")
+        return True
+    except OSError:
+        return False
+
+def _maxrss_kib() -> float:
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r / 1024 if sys.platform == "darwin" else r  # macOS em bytes, Linux em KiB
+
+def rss_peak(fn: Callable[[], Any]) -> float:
+    """Pico de RSS (KiB) acima do RSS de antes de `fn`, incluindo os buffers do Pillow."""
+    status = _rss_status() if _reset_rss_peak() else None
+    if status is None:
+        _release_free_memory()
+        before = _maxrss_kib(); fn(); return max(0.0, _maxrss_kib() - before)
+    fn()
+    after = _rss_status()
+    return float(max(0, after[1] - status[0])) if after else 0.0
+
+def measure(fn: Callable[[], Any], repeat: int, setup: Optional[Callable] = None, teardown: Optional[Callable] = None) -> Dict[str, Any]:
+    """Latência em `repeat` execuções + uma execução extra sob tracemalloc e outra para o pico de RSS
+    (ambas fora da cronometragem)."""
+    samples = []
+    for _ in range(repeat):
+        if setup: setup()
+        t = time.perf_counter(); fn(); samples.append((time.perf_counter() - t) * 1e3)
+        if teardown: teardown()
+
+    if setup: setup()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    start, _ = tracemalloc.get_traced_memory()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    blocks = sum(s.count_diff for s in tracemalloc.take_snapshot().compare_to(before, "filename"))
+    tracemalloc.stop()
+    if teardown: teardown()
+
+    if setup: setup()
+    rss = rss_peak(fn)
+    if teardown: teardown()
+
+    p50, p90, p99 = np.percentile(samples, [50, 90, 99])
+    return {"n": repeat, "p50_ms": round(float(p50), 3), "p90_ms": round(float(p90), 3), "p99_ms": round(float(p99), 3),
+            "mean_ms": round(float(np.mean(samples)), 3), "min_ms": round(min(samples), 3), "max_ms": round(max(samples), 3),
+            "peak_kib": round((peak - start) / 1024, 1), "rss_peak_kib": round(rss, 1), "net_blocks": blocks}
+
+
+def bench_config(m, image: Image.Image, width: int, colors: int, cs: int, repeat: int, seed: int = 0) -> List[Dict[str, Any]]:
+    rng = np.random.default_rng(seed)
+    s = m.TramaGridSession()
+    s.original = image
+    s.grid_width_cells, s.max_colors, s.cell_size = width, colors, cs
+    s.history_budget = 1 << 40  # sem descarte: undo sempre encontra a entrada da operação
+    results: List[Dict[str, Any]] = []
+
+    def rec(op: str, fn, setup=None, teardown=None):
+        r = measure(fn, repeat, setup, teardown)
+        results.append({"width": width, "max_colors": colors, "cell_size": cs, "op": op, **r})
+
+    rec("generate_grid", s.generate_grid, setup=s._stages.clear)
+    wc, hc = s.quantized.size
+    rec("grid_layers_cold", s._draw_grid, setup=m.grid_layers.cache_clear)
+    rec("_draw_grid", s._draw_grid)
+    s.show_grid = False
+    rec("_draw_grid[no_grid]", s._draw_grid)
+    s.show_grid = True
+    s._draw_grid()
+
+    keys = [i for i, _ in sorted(s._index_usage(), key=lambda u: -u[1]) if i in s.palette]
+    a, b = keys[0], keys[-1]
+    cells = iter([(int(rng.integers(wc)), int(rng.integers(hc)), keys[int(rng.integers(len(keys)))]) for _ in range(4 * repeat + 4)])
+    boxes = iter([(int(rng.integers(max(1, wc - 20))), int(rng.integers(max(1, hc - 20)))) for _ in range(repeat + 2)])
+
+    rec("paint_cell", lambda: s.paint_cell(*next(cells)), teardown=s.undo)
+    rec("undo[paint]", s.undo, setup=lambda: s.paint_cell(*next(cells)))
+    rec("merge_colors", lambda: s.merge_colors(a, b), teardown=s.undo)
+    rec("undo[merge]", s.undo, setup=lambda: s.merge_colors(a, b))
+    rec("delete_color", lambda: s.delete_color(a), teardown=s.undo)
+    rec("replace_index_in_region", lambda: s.replace_index_in_region(*next(boxes), 20, 20, a, b), teardown=s.undo)
+    rec("get_palette_info", s.get_palette_info, setup=s._bump_version)
+    rec("get_grid_base64", s.get_grid_base64, setup=s._bump_version)
+
+    sid = f"bench-{width}-{colors}-{cs}"
+    def dirty():
+        s._mark_dirty("original", "quantized"); s._saved_meta = None
+    rec("save_to_disk", lambda: s.save_to_disk(sid), setup=dirty)
+    rec("load_from_disk", lambda: m.TramaGridSession().load_from_disk(sid))
+    # load_from_disk só lê meta.json e cells.bin; a reabertura a frio termina no primeiro grid_image
+    def reopen():
+        t = m.TramaGridSession(); t.load_from_disk(sid); return t.grid_image
+    rec("reopen[grid_image]", reopen)
+    return results
+
+
+def compare(results: List[Dict], baseline: List[Dict], tolerance: float, min_ms: float) -> List[Tuple[Dict, Dict, float]]:
+    """(atual, base, razão) das operações que ficaram mais lentas que a base além da tolerância."""
+    key = lambda r: (r["width"], r["max_colors"], r["cell_size"], r["op"])
+    base = {key(r): r for r in baseline}
+    slower = []
+    for r in results:
+        ref = base.get(key(r))
+        if not ref: continue
+        ratio = r["p50_ms"] / max(ref["p50_ms"], 1e-6)
+        if ratio > 1 + tolerance and r["p50_ms"] - ref["p50_ms"] > min_ms: slower.append((r, ref, ratio))
+    return slower
+
+
+def print_table(results: List[Dict]) -> None:
+    print(f"{'largura':>7} {'cores':>5} {'cs':>3}  {'operação':<24} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'pico KiB':>9} {'RSS KiB':>9} {'blocos':>7}")
+    for r in results:
+        print(f"{r['width']:>7} {r['max_colors']:>5} {r['cell_size']:>3}  {r['op']:<24} {r['p50_ms']:>9.2f} {r['p90_ms']:>9.2f} "
+              f"{r['p99_ms']:>9.2f} {r['peak_kib']:>9.1f} {r.get('rss_peak_kib', 0):>9.1f} {r['net_blocks']:>7}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ints = lambda v: [int(x) for x in v.split(",")]
+    ap = argparse.ArgumentParser(description="Benchmark offline de TramaGridSession")
+    ap.add_argument("--widths", type=ints, default=[50, 100, 200, 400], help="grid_width_cells (lista separada por vírgula)")
+    ap.add_argument("--colors", type=ints, default=[8, 16, 32, 64], help="max_colors")
+    ap.add_argument("--cell-sizes", type=ints, default=[10, 22], help="cell_size")
+    ap.add_argument("--repeat", type=int, default=5, help="execuções cronometradas por operação")
+    ap.add_argument("--image-size", type=ints, default=[1600, 1200], help="largura,altura da imagem sintética")
+    ap.add_argument("--quick", action="store_true", help="só largura 130, 16 cores, cell_size 22, 3 repetições")
+    ap.add_argument("--out", default="bench_results.json", help="arquivo JSON de saída")
+    ap.add_argument("--baseline", help="JSON de uma rodada anterior para comparação")
+    ap.add_argument("--tolerance", type=float, default=0.25, help="lentidão relativa aceita no p50 (0.25 = +25%%)")
+    ap.add_argument("--min-ms", type=float, default=1.0, help="diferença absoluta mínima (ms) para contar como regressão")
+    args = ap.parse_args(argv)
+    if args.quick: args.widths, args.colors, args.cell_sizes, args.repeat = [130], [16], [22], 3
+
+    out_path = os.path.abspath(args.out)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f: baseline = json.load(f)["results"]
+
+    # Sem chaves externas e com DATA_DIR isolado: o módulo é importado de dentro de um diretório temporário
+    for k in ("SUPABASE_URL", "SUPABASE_SERVICE_KEY", "STRIPE_API_KEY", "STRIPE_WEBHOOK_SECRET"): os.environ[k] = ""
+    os.environ.setdefault("TRAMAGRID_PERSIST_DELAY", "0")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    tmp = tempfile.TemporaryDirectory(prefix="tramagrid-bench-")
+    os.chdir(tmp.name)
+    import tramagrid_backend as m
+
+    image = synthetic_image(*args.image_size)
+    results: List[Dict[str, Any]] = []
+    for width in args.widths:
+        for colors in args.colors:
+            for cs in args.cell_sizes:
+                t = time.perf_counter()
+                results.extend(bench_config(m, image, width, colors, cs, args.repeat))
+                print(f"• largura={width} cores={colors} cs={cs}: {time.perf_counter() - t:.1f}s", file=sys.stderr)
+
+    print_table(results)
+    import PIL
+    meta = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(), "platform": platform.platform(),
+            "numpy": np.__version__, "pillow": PIL.__version__, "cpus": os.cpu_count(), "repeat": args.repeat,
+            "image_size": args.image_size}
+    with open(out_path, "w", encoding="utf-8") as f: json.dump({"meta": meta, "results": results}, f, indent=1)
+    print(f"\n✅ Resultados em {out_path}")
+    tmp.cleanup()
+
+    if baseline is None: return 0
+    slower = compare(results, baseline, args.tolerance, args.min_ms)
+    if not slower:
+        print(f"✅ Nenhuma regressão acima de {args.tolerance:.0%} em relação a {args.baseline}")
+        return 0
+    print(f"\n❌ {len(slower)} regressão(ões) em relação a {args.baseline}:")
+    for r, ref, ratio in slower:
+        print(f"  {r['op']:<24} largura={r['width']} cores={r['max_colors']} cs={r['cell_size']}: "
+              f"{ref['p50_ms']:.2f} -> {r['p50_ms']:.2f} ms (x{ratio:.2f})")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
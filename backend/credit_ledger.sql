@@ -0,0 +1,61 @@
+-- Ledger de créditos do TramaGrid (rodar uma vez no SQL Editor do Supabase).
+-- O backend chama estas funções via /rest/v1/rpc com a service key: cada chamada é uma
+-- única operação condicional, sem select + update separados.
+
+-- Eventos do Stripe já aplicados (idempotência do webhook)
+create table if not exists public.stripe_events (
+  id text primary key,
+  user_id uuid not null,
+  credits integer not null,
+  created_at timestamptz not null default now()
+);
+alter table public.stripe_events enable row level security;
+
+-- Gasta a geração grátis ou 1 crédito.
+-- Retorna 'free' | 'credit' | 'insufficient' | 'not_found'
+create or replace function public.consume_credit(p_user_id uuid)
+returns text
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  update profiles set free_generation_used = true
+   where id = p_user_id and coalesce(free_generation_used, false) = false;
+  if found then return 'free'; end if;
+
+  update profiles set credits = credits - 1
+   where id = p_user_id and coalesce(credits, 0) > 0;
+  if found then return 'credit'; end if;
+
+  perform 1 from profiles where id = p_user_id;
+  if found then return 'insufficient'; end if;
+  return 'not_found';
+end;
+$$;
+
+-- Soma créditos uma única vez por evento do Stripe; false se o evento já foi aplicado.
+-- Erro se o perfil não existir (nada é registrado)
+create or replace function public.add_credits(p_user_id uuid, p_amount integer, p_event_id text)
+returns boolean
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  insert into stripe_events (id, user_id, credits) values (p_event_id, p_user_id, p_amount)
+  on conflict (id) do nothing;
+  if not found then return false; end if;
+
+  update profiles set credits = coalesce(credits, 0) + p_amount where id = p_user_id;
+  -- Sem perfil: desfaz o registro do evento e falha, para o webhook responder erro e o Stripe reenviar
+  if not found then raise exception 'perfil % não encontrado', p_user_id; end if;
+  return true;
+end;
+$$;
+
+-- Só o backend (service_role) pode chamar
+revoke execute on function public.consume_credit(uuid) from public, anon, authenticated;
+revoke execute on function public.add_credits(uuid, integer, text) from public, anon, authenticated;
+grant execute on function public.consume_credit(uuid) to service_role;
+grant execute on function public.add_credits(uuid, integer, text) to service_role;
@@ -4,17 +4,28 @@ import json
 import io
 import base64
 import uuid
-import math
+import asyncio
+import struct
+import time
+import threading
+import abc
+import bisect
+import contextlib
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import stripe 
 from dotenv import load_dotenv
 from pathlib import Path # <--- Importante para achar o caminho certo
+import numpy as np
 from PIL import Image, ImageDraw, ImageEnhance, ImageOps
-from collections import defaultdict
-from fastapi import FastAPI, UploadFile, File, HTTPException, Response, Request
+from fastapi import FastAPI, UploadFile, File, HTTPException, Response, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, Dict, Tuple, List, Any
-from supabase import create_client, Client 
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field
+from typing import Optional, Dict, Tuple, List, Any, Literal, Callable, Union, Annotated
+import httpx
 
 # ================= CONFIGURAÇÃO DE AMBIENTE (ROBUSTA) =================
 # Força o Python a procurar o .env na mesma pasta deste arquivo
@@ -34,31 +45,496 @@ STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
 
-try:
-    if SUPABASE_URL and SUPABASE_SERVICE_KEY:
-        supabase_admin: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
-        print("✅ Supabase Admin conectado!")
-    else:
-        print("⚠️ Variáveis do Supabase faltando no .env")
-        supabase_admin = None
-except Exception as e:
-    print(f"⚠️ Erro ao conectar Supabase: {e}")
-    supabase_admin = None
+if SUPABASE_URL and SUPABASE_SERVICE_KEY:
+    print("✅ Supabase configurado!")
+else:
+    print("⚠️ Variáveis do Supabase faltando no .env")
+
+# ================= MOTOR DE RENDERIZAÇÃO (GRADE) =================
+# A grade é montada a partir da matriz de índices (1 byte por célula) com uma
+# tabela de cores de 256 entradas. Tudo o que não depende das cores (legendas,
+# linhas de 10/1 células) é desenhado uma única vez por geometria e reaproveitado.
+GRID_MARGIN = 50
+GRID_TILE = 256  # lado (px) dos blocos de /api/grid/tile
+
+def _row_ids(a: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Linhas distintas de `a` (1ª ocorrência) e o id de cada linha; np.unique(axis=0) ordena linhas inteiras e é lento aqui
+    ids: Dict[bytes, int] = {}
+    first: List[int] = []
+    inverse = np.empty(len(a), dtype=np.intp)
+    for i, row in enumerate(a):
+        j = ids.setdefault(row.tobytes(), len(first))
+        if j == len(first): first.append(i)
+        inverse[i] = j
+    return np.asarray(first, dtype=np.intp), inverse
+
+@lru_cache(maxsize=None)
+def _blend_lut(alpha: int, color: int = 255) -> np.ndarray:
+    # Resultado exato do alpha_composite de cinza `color` (branco) com `alpha` sobre cada valor 0..255
+    dst = Image.frombytes("RGBA", (256, 1), bytes(v for i in range(256) for v in (i, i, i, 255)))
+    src = Image.new("RGBA", (256, 1), (color, color, color, alpha))
+    return np.asarray(Image.alpha_composite(dst, src))[0, :, 0].copy()
+
+class GridLayers:
+    """Camadas pré-calculadas de uma geometria (wc, hc, cell_size, show_grid)."""
+
+    def __init__(self, wc: int, hc: int, cs: int, show_grid: bool):
+        m = GRID_MARGIN
+        self.wc, self.hc, self.cs, self.show_grid = wc, hc, cs, show_grid
+        self.size = total_w, total_h = (m + wc * cs + 20, m + hc * cs + 20)
+
+        # Linhas da grade: só o alpha importa (são sempre brancas sobre a célula)
+        overlay = Image.new("L", self.size, 0)
+        if show_grid:
+            d_ov = ImageDraw.Draw(overlay)
+            for y in range(hc + 1):
+                py = m + y * cs
+                thk = (y % 10 == 0 or y == 0 or y == hc)
+                d_ov.line([(m, py), (m + wc * cs, py)], fill=180 if thk else 70, width=2 if thk else 1)
+            for x in range(wc + 1):
+                px = m + x * cs
+                thk = (x % 10 == 0 or x == 0 or x == wc)
+                d_ov.line([(px, m), (px, m + hc * cs)], fill=180 if thk else 70, width=2 if thk else 1)
+        alpha = np.asarray(overlay)
+        first, pat_of_row = _row_ids(alpha)
+        alpha_pats = alpha[first]
+
+        # Com grade, cada célula cobre cs+1 px (a borda é sobrescrita pela vizinha);
+        # sem grade, é o resize NEAREST exato de cs px por célula.
+        ext = 1 if show_grid else 0
+        area_w, area_h = wc * cs + ext, hc * cs + ext
+        ys, xs = np.flatnonzero(alpha_pats.any(axis=1)[pat_of_row]), np.flatnonzero(alpha_pats.any(axis=0))
+        self.y0 = min(m, int(ys.min())) if ys.size else m
+        self.x0 = min(m, int(xs.min())) if xs.size else m
+        self.y1 = max(m + area_h, int(ys.max()) + 1) if ys.size else m + area_h
+        self.x1 = max(m + area_w, int(xs.max()) + 1) if xs.size else m + area_w
+
+        # Classe de cada pixel da área: 0 = cor pura da célula, k = linha com alpha_values[k-1]
+        self.alpha_values = [int(a) for a in np.unique(alpha_pats) if a]
+        self.blends = [_blend_lut(a) for a in self.alpha_values]
+        to_cls = np.zeros(256, dtype=np.uint8)
+        for k, a in enumerate(self.alpha_values, 1): to_cls[a] = k
+        self.cls_pats = to_cls[alpha_pats[:, self.x0:self.x1]]
+        self.cls_of_row = pat_of_row[self.y0:self.y1]
+
+        # Pixel -> célula (hc / wc = sentinela branca fora da área)
+        self.row_map = self._axis_map(total_h, area_h, hc)
+        self.col_map = self._axis_map(total_w, area_w, wc)
+
+        # Linhas de pixel com a mesma célula e o mesmo padrão de linhas são idênticas:
+        # cada combinação é calculada uma vez e replicada com np.take.
+        keys = np.stack([self.row_map[self.y0:self.y1], self.cls_of_row], axis=1)
+        combos, inner_of_row = np.unique(keys, axis=0, return_inverse=True)
+        self.inner_rows = combos[:, 0]
+
+        # Por padrão de linhas: as combinações que o usam e, para cada coluna da área, a posição
+        # (classe, célula) na tabela de cores. A máscara de classes vira um único índice de colunas,
+        # então cada pixel é lido uma vez, só na classe que cai sobre ele.
+        cols = self.col_map[self.x0:self.x1]
+        self.pat_cols: List[Tuple[np.ndarray, np.ndarray]] = [
+            (np.flatnonzero(combos[:, 1] == pat), self.cls_pats[pat].astype(np.intp) * (wc + 1) + cols)
+            for pat in np.unique(combos[:, 1])]
+
+        # Legendas: faixa de cima (linhas < y0) e faixa da esquerda (colunas < x0), o resto é branco
+        top = Image.new("RGBA", (total_w, self.y0), (255, 255, 255, 255))
+        left = Image.new("RGBA", (self.x0, total_h), (255, 255, 255, 255))
+        if show_grid:
+            d_top, d_left = ImageDraw.Draw(top), ImageDraw.Draw(left)
+            for x in range(wc):
+                if (x+1)%5==0 or x==0: d_top.text((m + x*cs + 11, 25), str(x+1), fill=(100,100,100), anchor="mm")
+            for y in range(hc):
+                if (y+1)%5==0 or y==0: d_left.text((20, m + y*cs + 11), str(y+1), fill=(100,100,100), anchor="mm")
+        top_rows, top_of_row = self._opaque_rows(top)
+        self.left_rows, left_of_row = self._opaque_rows(left)
+        self.left_of_row = left_of_row[self.y0:]
+
+        # Tabela de linhas do render: [combinações internas..., branca, faixa de cima...]
+        n = len(combos)
+        self.top_rows = top_rows
+        self.row_table = np.full(total_h, n, dtype=np.intp)
+        self.row_table[:self.y0] = n + 1 + top_of_row
+        self.row_table[self.y0:self.y1] = inner_of_row.reshape(-1)
+
+    @staticmethod
+    def _opaque_rows(img: Image.Image) -> Tuple[np.ndarray, np.ndarray]:
+        # Linhas distintas da legenda (opaca) em RGB
+        px = np.asarray(img.convert("RGB"))
+        first, of_row = _row_ids(px)
+        return px[first], of_row
+
+    def _axis_map(self, n_px: int, area: int, n: int) -> np.ndarray:
+        rel = np.arange(n_px) - GRID_MARGIN
+        inside = (rel >= 0) & (rel < area)
+        return np.where(inside, np.minimum(np.maximum(rel, 0) // self.cs, n - 1), n)
+
+    def _luts(self, lut: np.ndarray) -> np.ndarray:
+        # (classes, 257, 3) uint8: cor de cada índice pura e sob cada tipo de linha; 256 = branco
+        luts = np.full((1 + len(self.blends), 257, 3), 255, dtype=np.uint8)
+        luts[0, :256] = lut
+        for k, b in enumerate(self.blends, 1): luts[k, :256] = b[lut]
+        return luts
+
+    def color_table(self, cells: np.ndarray, lut: np.ndarray) -> np.ndarray:
+        """(classes, hc+1, wc+1, 3) uint8 com a borda sentinela branca."""
+        ext = np.full((self.hc + 1, self.wc + 1), 256, dtype=np.intp)
+        ext[:self.hc, :self.wc] = cells
+        return self._luts(lut)[:, ext]
+
+    def render(self, cells: np.ndarray, lut: np.ndarray) -> Image.Image:
+        # Linha de células -> [classe 0: células..., classe 1: células..., ...]; cada pixel RGB vira
+        # um item "V3" para o gather copiar 3 bytes de uma vez
+        colors = self.color_table(cells, lut).transpose(1, 0, 2, 3)
+        colors = np.ascontiguousarray(colors).reshape(self.hc + 1, -1, 3).view("V3")[..., 0]
+        n = len(self.inner_rows)
+        table = np.full((n + 1 + len(self.top_rows), self.size[0], 3), 255, dtype=np.uint8)
+        inner = table.view("V3")[:n, self.x0:self.x1, 0]
+        for combos, idx in self.pat_cols: inner[combos] = colors[self.inner_rows[combos]][:, idx]
+        table[n + 1:] = self.top_rows
+        out = np.take(table, self.row_table, axis=0)
+        out[self.y0:, :self.x0] = self.left_rows[self.left_of_row]
+        return Image.frombytes("RGB", self.size, out)
+
+    def render_region(self, cells: np.ndarray, lut: np.ndarray, x0: int, y0: int, x1: int, y1: int) -> Tuple[Tuple[int, int], Image.Image]:
+        """Redesenha só os pixels das células [x0,x1) x [y0,y1), com as linhas que as cruzam."""
+        rows = np.flatnonzero((self.row_map >= y0) & (self.row_map < y1))
+        cols = np.flatnonzero((self.col_map >= x0) & (self.col_map < x1))
+        sub = cells[np.ix_(self.row_map[rows], self.col_map[cols])]
+        cls = self.cls_pats[self.cls_of_row[rows - self.y0]][:, cols - self.x0]
+        out = self._luts(lut)[cls, sub]
+        return (int(cols[0]), int(rows[0])), Image.frombytes("RGB", (cols.size, rows.size), out)
+
+@lru_cache(maxsize=16)
+def grid_layers(wc: int, hc: int, cs: int, show_grid: bool) -> GridLayers:
+    return GridLayers(wc, hc, cs, show_grid)
+
+def palette_lut(palette: Dict[int, Tuple[int, int, int]]) -> np.ndarray:
+    lut = np.full((256, 3), 255, dtype=np.uint8)
+    for i, c in palette.items():
+        if 0 <= i < 256: lut[i] = c
+    return lut
+
+# ================= ANÁLISE DE PALETA (CIEDE2000) =================
+# Distâncias perceptuais entre as cores da paleta, calculadas uma vez por paleta e
+# reaproveitadas por delete_color (cor mais próxima) e pelas sugestões de agrupamento.
+CLUSTER_THRESHOLD = 10.0  # ΔE00 padrão (~ distância RGB 50 do agrupamento antigo)
+CLUSTER_LEVELS = (2.0, 4.0, 6.0, 8.0, 10.0, 12.0, 15.0, 20.0, 25.0, 30.0)
+
+_RGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]])
+_WHITE_D65 = np.array([0.95047, 1.0, 1.08883])
+
+def _srgb_to_lab(rgb: np.ndarray) -> np.ndarray:
+    c = rgb / 255.0
+    c = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    xyz = (c @ _RGB_TO_XYZ.T) / _WHITE_D65
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+def _ciede2000(lab1: np.ndarray, lab2: np.ndarray) -> np.ndarray:
+    # Fórmula de Sharma et al. (2005), vetorizada com broadcasting entre lab1 e lab2
+    L1, a1, b1 = np.moveaxis(lab1, -1, 0)
+    L2, a2, b2 = np.moveaxis(lab2, -1, 0)
+    c7 = ((np.hypot(a1, b1) + np.hypot(a2, b2)) / 2) ** 7
+    g = 0.5 * (1 - np.sqrt(c7 / (c7 + 25.0 ** 7)))
+    a1, a2 = a1 * (1 + g), a2 * (1 + g)
+    c1, c2 = np.hypot(a1, b1), np.hypot(a2, b2)
+    h1, h2 = np.degrees(np.arctan2(b1, a1)) % 360, np.degrees(np.arctan2(b2, a2)) % 360
+    chroma0 = c1 * c2 == 0
+
+    dh = h2 - h1
+    dh = np.where(chroma0, 0, np.where(dh > 180, dh - 360, np.where(dh < -180, dh + 360, dh)))
+    d_l, d_c = L2 - L1, c2 - c1
+    d_h = 2 * np.sqrt(c1 * c2) * np.sin(np.radians(dh / 2))
+
+    l_bar, c_bar, h_sum = (L1 + L2) / 2, (c1 + c2) / 2, h1 + h2
+    h_bar = np.where(chroma0, h_sum, np.where(np.abs(h1 - h2) <= 180, h_sum / 2,
+                     np.where(h_sum < 360, (h_sum + 360) / 2, (h_sum - 360) / 2)))
+    t = (1 - 0.17 * np.cos(np.radians(h_bar - 30)) + 0.24 * np.cos(np.radians(2 * h_bar))
+         + 0.32 * np.cos(np.radians(3 * h_bar + 6)) - 0.20 * np.cos(np.radians(4 * h_bar - 63)))
+    c7 = c_bar ** 7
+    r_t = -2 * np.sqrt(c7 / (c7 + 25.0 ** 7)) * np.sin(np.radians(60 * np.exp(-((h_bar - 275) / 25) ** 2)))
+    s_l = 1 + 0.015 * (l_bar - 50) ** 2 / np.sqrt(20 + (l_bar - 50) ** 2)
+    s_c, s_h = 1 + 0.045 * c_bar, 1 + 0.015 * c_bar * t
+    return np.sqrt((d_l / s_l) ** 2 + (d_c / s_c) ** 2 + (d_h / s_h) ** 2 + r_t * (d_c / s_c) * (d_h / s_h))
+
+class PaletteAnalysis:
+    """Matriz ΔE00 entre as cores de uma paleta (na ordem do dicionário)."""
+
+    def __init__(self, colors: Tuple[Tuple[int, Tuple[int, int, int]], ...]):
+        self.keys = [k for k, _ in colors]
+        self.pos = {k: i for i, k in enumerate(self.keys)}
+        lab = _srgb_to_lab(np.array([c for _, c in colors], dtype=np.float64).reshape(-1, 3))
+        self.dist = _ciede2000(lab[:, None], lab[None, :])
+
+    def nearest(self, idx: int) -> Optional[int]:
+        # Cor mais próxima de `idx` (empate: a primeira na ordem da paleta)
+        if idx not in self.pos or len(self.keys) < 2: return None
+        d = self.dist[self.pos[idx]].copy()
+        d[self.pos[idx]] = np.inf
+        return self.keys[int(np.argmin(d))]
+
+    def clusters(self, threshold: float, counts: List[int]) -> List[List[int]]:
+        # Cores usadas, da mais para a menos frequente; cada semente livre agrupa as cores
+        # livres a menos de `threshold` dela. Grupos saem ordenados por uso (1º = mais usada).
+        order = sorted((i for i, k in enumerate(self.keys) if counts[k]), key=lambda i: -counts[self.keys[i]])
+        free = np.zeros(len(self.keys), dtype=bool); free[order] = True
+        groups = []
+        for i in order:
+            if not free[i]: continue
+            members = [j for j in order if free[j] and self.dist[i, j] < threshold]
+            if len(members) > 1:
+                free[members] = False
+                groups.append([self.keys[j] for j in members])
+        return groups
+
+@lru_cache(maxsize=32)
+def palette_analysis(colors: Tuple[Tuple[int, Tuple[int, int, int]], ...]) -> PaletteAnalysis:
+    return PaletteAnalysis(colors)
+
+# ================= MÉTRICAS =================
+# Histogramas de latência por rota (middleware) e, opcionalmente, por etapa interna
+# (generate_grid, _draw_grid, codificação PNG, gravação em disco), expostos em /metrics no
+# formato texto do Prometheus e no cabeçalho Server-Timing. TRAMAGRID_METRICS=0 nem instala
+# o middleware; sem TRAMAGRID_STAGE_TIMERS=1 as etapas não são cronometradas.
+METRICS_ENABLED = os.getenv("TRAMAGRID_METRICS", "1") == "1"
+STAGE_TIMERS = os.getenv("TRAMAGRID_STAGE_TIMERS", "0") == "1"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+    def lines(self, name: str, labels: str) -> List[str]:
+        out, acc = [], 0
+        for le, n in zip(LATENCY_BUCKETS + ("+Inf",), self.counts):
+            acc += n
+            out.append(f'{name}_bucket{{{labels},le="{le}"}} {acc}')
+        return out + [f"{name}_sum{{{labels}}} {self.sum:.6f}", f"{name}_count{{{labels}}} {acc}"]
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routes: Dict[Tuple[str, str, int], Histogram] = {}
+        self.stages: Dict[str, Histogram] = {}
+
+    def _observe(self, table: Dict, key: Any, seconds: float) -> None:
+        with self._lock:
+            h = table.get(key)
+            if h is None: h = table[key] = Histogram()
+            h.observe(seconds)
+
+    def observe_route(self, method: str, route: str, status: int, seconds: float) -> None:
+        self._observe(self.routes, (method, route, status), seconds)
+
+    def observe_stage(self, name: str, seconds: float) -> None:
+        self._observe(self.stages, name, seconds)
+
+    def render(self, gauges: List[Tuple[str, str, str, float]]) -> str:
+        # gauges: (nome, tipo, descrição, valor)
+        lines = ["# HELP tramagrid_request_seconds Latência das rotas HTTP.", "# TYPE tramagrid_request_seconds histogram"]
+        with self._lock:
+            for (method, route, status), h in sorted(self.routes.items()):
+                lines += h.lines("tramagrid_request_seconds", f'method="{method}",route="{route}",status="{status}"')
+            lines += ["# HELP tramagrid_stage_seconds Duração das etapas internas.", "# TYPE tramagrid_stage_seconds histogram"]
+            for name, h in sorted(self.stages.items()):
+                lines += h.lines("tramagrid_stage_seconds", f'stage="{name}"')
+        for name, kind, help_text, value in gauges:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+# Etapas cronometradas durante a requisição atual (para o Server-Timing); None fora de requisições
+_request_timings: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar("tramagrid_timings", default=None)
+
+class _StageTimer:
+    __slots__ = ("name", "t0")
+
+    def __init__(self, name: str): self.name = name
+
+    def __enter__(self): self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc) -> None:
+        dt = time.perf_counter() - self.t0
+        metrics.observe_stage(self.name, dt)
+        timings = _request_timings.get()
+        if timings is not None: timings.append((self.name, dt))
+
+_NO_TIMER = contextlib.nullcontext()
+
+def timed(name: str):
+    return _StageTimer(name) if STAGE_TIMERS else _NO_TIMER
 
 # ================= LÓGICA DE PROCESSAMENTO (SESSÃO) =================
 DATA_DIR = "data"
 os.makedirs(DATA_DIR, exist_ok=True)
-sessions: Dict[str, "TramaGridSession"] = {}
+
+# Cache de sessões em memória (o restante fica em DATA_DIR e é recarregado sob demanda)
+SESSION_CACHE_BYTES = int(os.getenv("TRAMAGRID_SESSION_CACHE_BYTES", str(512 << 20)))
+SESSION_IDLE_TTL = float(os.getenv("TRAMAGRID_SESSION_IDLE_TTL", "1800"))
+# Execução fora do event loop: nº de threads e limite global de tarefas na fila
+WORKER_THREADS = int(os.getenv("TRAMAGRID_WORKERS", str(min(8, (os.cpu_count() or 1) + 2))))
+MAX_PENDING_TASKS = int(os.getenv("TRAMAGRID_MAX_PENDING", "64"))
+RETRY_AFTER_SECONDS = 2
+# Janela de agrupamento das gravações em disco (segundos)
+PERSIST_DELAY = float(os.getenv("TRAMAGRID_PERSIST_DELAY", "0.5"))
+# Entrada de imagens: a original de trabalho só guarda a resolução que a maior grade usa
+# (4x a largura, folga para o LANCZOS do _resize); acima dos limites o upload é recusado
+MAX_GRID_WIDTH = int(os.getenv("TRAMAGRID_MAX_GRID_WIDTH", "400"))
+WORK_WIDTH = MAX_GRID_WIDTH * 4
+MAX_UPLOAD_PIXELS = int(os.getenv("TRAMAGRID_MAX_PIXELS", str(128_000_000)))
+MAX_UPLOAD_BYTES = int(os.getenv("TRAMAGRID_MAX_UPLOAD_BYTES", str(64 << 20)))
+_MULTIPART_SLACK = 64 << 10  # cabeçalhos/fronteiras do multipart além do arquivo
+
+# Formato em disco: meta.json (params + paletas) + cells.bin (matriz de índices crua) + original.png.
+# cells.bin = cabeçalho (magic, versão, largura, altura) + paleta embutida (768 bytes) + W*H bytes.
+# Sessões antigas com quantized.png são migradas na primeira gravação.
+SESSION_FORMAT = 2
+_CELLS_MAGIC = b"TGIX"
+_CELLS_HEADER = struct.Struct("<4sHII")
+PNG_CACHE_BYTES = int(os.getenv("TRAMAGRID_PNG_CACHE_BYTES", str(8 << 20)))  # por sessão
+
+# Transporte da matriz de índices (/api/cells): cabeçalho, paleta (nº de entradas x
+# [índice, r, g, b]) e o corpo conforme o tipo:
+#   0 = bruto (W*H bytes), 1 = RLE (u32 nº de sequências + [valor u8, comprimento u16]...),
+#   2 = delta (u32 n + n posições u32 + n valores u8) em relação à versão `since`.
+_WIRE_MAGIC = b"TGWC"
+_WIRE_HEADER = struct.Struct("<4sBxHIII8s")  # magic, tipo, nº cores, W, H, versão, epoch
+WIRE_RAW, WIRE_RLE, WIRE_DELTA = 0, 1, 2
+
+def _write_cells(f, img: Image.Image) -> None:
+    pal = bytes((img.getpalette() or [])[:768]).ljust(768, b"\0")
+    f.write(_CELLS_HEADER.pack(_CELLS_MAGIC, 1, img.width, img.height)); f.write(pal); f.write(img.tobytes())
+
+def _read_cells(path: str) -> Image.Image:
+    with open(path, "rb") as f: data = f.read()
+    magic, version, w, h = _CELLS_HEADER.unpack_from(data)
+    start = _CELLS_HEADER.size + 768
+    if magic != _CELLS_MAGIC or version != 1 or len(data) != start + w * h:
+        raise ValueError(f"cells.bin inválido (magic={magic!r}, versão={version}, {len(data)} bytes)")
+    img = Image.frombytes("P", (w, h), data[start:])
+    img.putpalette(data[_CELLS_HEADER.size:start])
+    return img
+
+def _indices_from_rgb(img: Image.Image, palette: Dict[int, Tuple[int, int, int]]) -> Image.Image:
+    """quantized.png gravado em RGB (sessão antiga carregada e salva pela versão anterior):
+    volta aos índices pela cor exata de cada entrada da paleta. ValueError se sobrar pixel sem cor."""
+    colors: Dict[int, int] = {}
+    for i, (r, g, b) in palette.items():
+        if 0 <= i < 256: colors.setdefault(r << 16 | g << 8 | b, i)
+    if not colors: raise ValueError("quantized.png em RGB sem paleta para convertê-lo")
+    px = np.asarray(img.convert("RGB"), dtype=np.uint32)
+    codes = px[..., 0] << 16 | px[..., 1] << 8 | px[..., 2]
+    keys = np.array(sorted(colors), dtype=np.uint32)
+    pos = np.minimum(np.searchsorted(keys, codes), len(keys) - 1)
+    missing = int(np.count_nonzero(keys[pos] != codes))
+    if missing: raise ValueError(f"quantized.png em RGB com {missing} pixels fora da paleta")
+    out = Image.frombytes("P", img.size, np.array([colors[int(k)] for k in keys], dtype=np.uint8)[pos].tobytes())
+    out.putpalette(palette_lut(palette).tobytes())
+    return out
+
+def _pixel_bytes(img: Image.Image) -> int:
+    # Bytes por pixel no armazenamento do Pillow: 2+ bandas (RGB inclusive) ocupam 4; L/P/1 ocupam 1
+    if len(img.getbands()) > 1 or img.mode in ("I", "F"): return 4
+    return 2 if img.mode.startswith("I;16") else 1
+
+def _open_image(fp) -> Image.Image:
+    """Decodifica já na escala de trabalho: draft (escala DCT) no JPEG, reduce() nos demais."""
+    img = Image.open(fp)
+    if img.width * img.height > MAX_UPLOAD_PIXELS:
+        raise Image.DecompressionBombError(f"Imagem grande demais: {img.width}x{img.height} px")
+    if img.width > WORK_WIDTH:
+        size = (WORK_WIDTH, max(1, round(img.height * WORK_WIDTH / img.width)))
+        if img.format == "JPEG": img.draft("RGB", size)
+        if img.mode not in ("RGB", "L"): img = img.convert("RGB")
+        if img.width >= 2 * WORK_WIDTH: img = img.reduce(img.width // WORK_WIDTH)
+        if img.width > WORK_WIDTH: img = img.resize(size, Image.Resampling.LANCZOS)
+    return img.convert("RGB")
+
+def _rle(flat: np.ndarray) -> bytes:
+    starts = np.flatnonzero(np.r_[True, flat[1:] != flat[:-1]])
+    lengths = np.diff(np.r_[starts, flat.size])
+    reps = (lengths + 0xFFFE) // 0xFFFF  # sequências > 65535 são quebradas
+    runs = np.empty(int(reps.sum()), dtype=[("v", "u1"), ("n", "<u2")])
+    runs["v"] = np.repeat(flat[starts], reps)
+    runs["n"] = 0xFFFF
+    runs["n"][np.cumsum(reps) - 1] = lengths - 0xFFFF * (reps - 1)
+    return struct.pack("<I", runs.size) + runs.tobytes()
+
+def _highlight_row(img: Image.Image, row: int, cs: int, top: int = 0) -> Image.Image:
+    # Escurece tudo (preto alpha 160) menos a faixa interna da linha destacada (alpha 100),
+    # com tabelas por canal em vez de compor overlays RGBA do tamanho da imagem.
+    # `top` = y da imagem dentro da grade completa (blocos)
+    py = GRID_MARGIN + (row - 1) * cs - top
+    y0, y1 = max(0, min(img.height, py + 1)), max(0, min(img.height, py + cs))
+    out = img.point(_blend_lut(160, 0).tolist() * 3)
+    if y0 < y1: out.paste(img.crop((0, y0, img.width, y1)).point(_blend_lut(100, 0).tolist() * 3), (0, y0))
+    return out
+
+@lru_cache(maxsize=64)
+def _gamma_table(gamma: float) -> List[int]:
+    return [int(((i/255.0)**(1.0/gamma))*255) for i in range(256)]*3
+
+def _atomic_write(path: str, write) -> None:
+    # Grava em arquivo temporário e troca por rename: nunca sobra arquivo pela metade
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        write(f); f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+# Orçamento de memória do histórico de desfazer, por sessão
+HISTORY_BUDGET_BYTES = int(os.getenv("TRAMAGRID_HISTORY_BYTES", str(1 << 20)))
+_ENTRY_OVERHEAD = 64
+# Parâmetros só de visualização: não mudam índices nem paleta, então não entram no histórico
+_VIEW_PARAMS = frozenset({"highlighted_row", "show_grid"})
+
+def _pack_cells(flat: np.ndarray, n_cells: int) -> Tuple[np.ndarray, bool]:
+    # Posições (índice plano) como uint16/uint32 ou como bitmap, o que for menor
+    flat = np.asarray(flat)
+    dtype = np.uint16 if n_cells <= 1 << 16 else np.uint32
+    if flat.size * np.dtype(dtype).itemsize <= (n_cells + 7) // 8: return flat.astype(dtype), False
+    mask = np.zeros(n_cells, dtype=bool); mask[flat] = True
+    return np.packbits(mask), True
+
+def _unpack_cells(pos: np.ndarray, bitmap: bool, n_cells: int) -> np.ndarray:
+    if bitmap: return np.flatnonzero(np.unpackbits(pos, count=n_cells))
+    return pos.astype(np.intp)
 
 class TramaGridSession:
     def __init__(self):
-        self.original: Optional[Image.Image] = None
+        self._original: Optional[Image.Image] = None
+        self._original_path: Optional[str] = None
+        self._grid_image: Optional[Image.Image] = None
+        # Cache das etapas de generate_grid: nome -> (chave dos parâmetros, resultado)
+        self._stages: Dict[str, Tuple[Tuple, Image.Image]] = {}
         self.processed: Optional[Image.Image] = None
         self.quantized: Optional[Image.Image] = None
         self.palette: Dict[int, Tuple[int, int, int]] = {}
         self.custom_palette: Dict[int, Tuple[int, int, int]] = {}
-        self.grid_image: Optional[Image.Image] = None
         self.history: List[Dict[str, Any]] = []
+        self.history_bytes: int = 0
+        self.history_budget: int = HISTORY_BUDGET_BYTES
+        # Versão do estado: sobe a cada mudança de índices/paleta/imagem da grade. O epoch
+        # distingue instâncias (recarga do disco recomeça a contagem) nos ETags.
+        self.version: int = 0
+        self.epoch: str = uuid.uuid4().hex[:8]
+        # PNGs já codificados da versão atual: (highlighted_row,) ou (highlighted_row, tx, ty)
+        self._png: "OrderedDict[Tuple[int, ...], bytes]" = OrderedDict()
+        self._png_bytes: int = 0
+        # Versão da última mudança de cada célula (deltas de /api/cells): a matriz da última
+        # sincronização é comparada com a atual e as diferenças recebem a versão corrente
+        self._shadow: Optional[np.ndarray] = None
+        self._cell_ver: Optional[np.ndarray] = None
+        self._cells_base: int = 0
+        # Histograma de índices da versão atual: (versão, contagens)
+        self._hist: Optional[Tuple[int, List[int]]] = None
         
         self.grid_width_cells: int = 130
         self.cell_size: int = 22
@@ -73,10 +549,56 @@ class TramaGridSession:
         self.gauge_rows: int = 20
         self.show_grid: bool = True
 
-    def save_to_disk(self, session_id: str):
-        s_dir = os.path.join(DATA_DIR, session_id)
-        os.makedirs(s_dir, exist_ok=True)
-        meta = {
+        # Artefatos alterados desde a última gravação ("original", "quantized"); meta.json é comparado pelo conteúdo
+        self._dirty: set = set()
+        self._saved_meta: Optional[str] = None
+        # Serializa edições (executor) e gravações (writer / despejo) da mesma sessão
+        self.lock = threading.RLock()
+
+    # original e grid_image são carregados/renderizados só no primeiro uso
+    @property
+    def original(self) -> Optional[Image.Image]:
+        if self._original is None and self._original_path:
+            path, self._original_path = self._original_path, None
+            try: self._original = _open_image(path)
+            except OSError as e: print(f"⚠️ Falha ao abrir {path}: {e}")
+        return self._original
+
+    @original.setter
+    def original(self, img: Optional[Image.Image]) -> None:
+        self._original, self._original_path = img, None
+        self._stages = {}
+
+    @property
+    def grid_image(self) -> Optional[Image.Image]:
+        if self._grid_image is None and self.quantized: self._draw_grid()
+        return self._grid_image
+
+    @grid_image.setter
+    def grid_image(self, img: Optional[Image.Image]) -> None:
+        self._grid_image = img
+        self._bump_version()
+
+    def _bump_version(self) -> None:
+        self.version += 1
+        self._png.clear(); self._png_bytes = 0
+
+    def memory_bytes(self) -> int:
+        # Estimativa do que a sessão ocupa em RAM (imagens + histórico). Chamado pela cache sem o lock
+        # da sessão: copia os estágios antes de iterar, já que um worker pode estar alterando o dict
+        total = self.history_bytes + self._png_bytes
+        if self._shadow is not None: total += self._shadow.nbytes + self._cell_ver.nbytes
+        for img in (self._original, self.processed, self.quantized, self._grid_image, *(v for _, v in list(self._stages.values()))):
+            if img: total += img.width * img.height * _pixel_bytes(img)
+        return total
+
+    def _mark_dirty(self, *parts: str) -> None:
+        self._dirty.update(parts)
+        self._bump_version()
+
+    def _meta(self) -> Dict[str, Any]:
+        return {
+            "format": SESSION_FORMAT,
             "params": {
                 "grid_width_cells": self.grid_width_cells,
                 "max_colors": self.max_colors,
@@ -93,199 +615,769 @@ class TramaGridSession:
             "palette": {str(k): v for k, v in self.palette.items()},
             "custom_palette": {str(k): v for k, v in self.custom_palette.items()}
         }
-        with open(os.path.join(s_dir, "meta.json"), "w") as f: json.dump(meta, f)
-        if self.original: self.original.save(os.path.join(s_dir, "original.png"))
-        if self.quantized: self.quantized.save(os.path.join(s_dir, "quantized.png"))
+
+    def save_to_disk(self, session_id: str):
+        # Grava só o que mudou; chamada pelo writer em segundo plano, no despejo e no desligamento
+        with self.lock:
+            s_dir = os.path.join(DATA_DIR, session_id)
+            os.makedirs(s_dir, exist_ok=True)
+            dirty, self._dirty = self._dirty, set()
+            try:
+                meta = json.dumps(self._meta())
+                original = self._original if "original" in dirty else None
+                quantized = self.quantized.copy() if "quantized" in dirty and self.quantized else None
+                # meta.json por último: é o que marca a sessão como gravada no formato atual
+                if original:
+                    with timed("save.original"): _atomic_write(os.path.join(s_dir, "original.png"), lambda f: original.save(f, "PNG"))
+                if quantized:
+                    with timed("save.cells"): _atomic_write(os.path.join(s_dir, "cells.bin"), lambda f: _write_cells(f, quantized))
+                    legacy = os.path.join(s_dir, "quantized.png")
+                    if os.path.exists(legacy): os.remove(legacy)
+                if meta != self._saved_meta:
+                    with timed("save.meta"): _atomic_write(os.path.join(s_dir, "meta.json"), lambda f: f.write(meta.encode()))
+                    self._saved_meta = meta
+            except Exception:
+                self._dirty |= dirty
+                raise
 
     def load_from_disk(self, session_id: str) -> bool:
         s_dir = os.path.join(DATA_DIR, session_id)
         meta_path = os.path.join(s_dir, "meta.json")
         if not os.path.exists(meta_path): return False
         try:
-            with open(meta_path, "r") as f: meta = json.load(f)
+            with open(meta_path, "r") as f: raw = f.read()
+            meta = json.loads(raw)
             p = meta.get("params", {})
             for k, v in p.items(): 
                 if hasattr(self, k): setattr(self, k, v)
             self.palette = {int(k): tuple(v) for k, v in meta.get("palette", {}).items()}
             self.custom_palette = {int(k): tuple(v) for k, v in meta.get("custom_palette", {}).items()}
             if os.path.exists(os.path.join(s_dir, "original.png")):
-                self.original = Image.open(os.path.join(s_dir, "original.png")).convert("RGB")
-            if os.path.exists(os.path.join(s_dir, "quantized.png")):
-                self.quantized = Image.open(os.path.join(s_dir, "quantized.png")).convert("RGB")
-                self._draw_grid()
+                self._original, self._original_path = None, os.path.join(s_dir, "original.png")
+            self._dirty.clear(); self._saved_meta = raw
+            if os.path.exists(os.path.join(s_dir, "cells.bin")):
+                self.quantized = _read_cells(os.path.join(s_dir, "cells.bin"))
+            elif os.path.exists(os.path.join(s_dir, "quantized.png")):
+                # Sessão no formato antigo: a próxima gravação converte para cells.bin
+                img = Image.open(os.path.join(s_dir, "quantized.png"))
+                img.load()
+                self.quantized = img if img.mode == "P" else _indices_from_rgb(img, self.palette)
+                self._mark_dirty("quantized")
             return True
-        except: return False
+        except (OSError, ValueError, TypeError, struct.error) as e:
+            print(f"⚠️ Falha ao carregar sessão {session_id}: {e}")
+            return False
 
-    def _save_state(self):
+    # Histórico = lista de deltas reversos: aplicar o topo ao estado atual devolve o estado
+    # anterior à operação. Cada entrada pode ter 'cells' (posições + valores antigos),
+    # 'palette'/'custom_palette' ({índice: (posição, valor antigo | None)}) ou 'snapshot'.
+    def _save_state(self, cells: Optional[Tuple[np.ndarray, Any]] = None, keys: Tuple[int, ...] = ()):
         if not self.quantized: return
-        if len(self.history) >= 20: self.history.pop(0)
-        self.history.append({'quantized': self.quantized.copy(), 'palette': self.palette.copy(), 'custom_palette': self.custom_palette.copy()})
+        entry: Dict[str, Any] = {}
+        size = _ENTRY_OVERHEAD
+        if cells is not None and np.size(cells[0]):
+            n = self.quantized.width * self.quantized.height
+            pos, bitmap = _pack_cells(cells[0], n)
+            old = cells[1] if np.isscalar(cells[1]) else np.asarray(cells[1], dtype=np.uint8)
+            entry['cells'] = (pos, bitmap, old)
+            size += pos.nbytes + np.size(old)
+        for name in ('palette', 'custom_palette'):
+            d = getattr(self, name); order = list(d)
+            diff = {k: (order.index(k), d[k]) if k in d else (-1, None) for k in keys}
+            if diff: entry[name] = diff; size += 48 * len(diff)
+        entry['bytes'] = size
+        self._push_history(entry)
+
+    def _push_history(self, entry: Dict[str, Any]) -> None:
+        self.history.append(entry)
+        self.history_bytes += entry['bytes']
+        while len(self.history) > 1 and self.history_bytes > self.history_budget:
+            self.history_bytes -= self.history.pop(0)['bytes']
+
+    def _apply_entry(self, entry: Dict[str, Any], quantized: Image.Image, palette: Dict, custom: Dict) -> Tuple[Image.Image, Dict, Dict, Optional[Tuple[int, int, int, int]]]:
+        if 'snapshot' in entry:
+            snap = entry['snapshot']
+            return snap['quantized'], snap['palette'], snap['custom_palette'], None
+        box = None
+        if 'cells' in entry:
+            pos, bitmap, old = entry['cells']
+            w = quantized.width
+            flat = _unpack_cells(pos, bitmap, w * quantized.height)
+            ys, xs = flat // w, flat % w
+            box = (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+            sub = np.array(quantized.crop(box))
+            sub[ys - box[1], xs - box[0]] = old
+            quantized.paste(Image.frombytes("P", (box[2] - box[0], box[3] - box[1]), sub.tobytes()), box[:2])
+        for name, d in (('palette', palette), ('custom_palette', custom)):
+            diff = entry.get(name)
+            if not diff: continue
+            # Tira todas as chaves do delta e reinsere as antigas nas posições originais
+            # (um lote pode remover e recriar a mesma chave, mudando sua posição)
+            items = [(k, v) for k, v in d.items() if k not in diff]
+            for i, k, v in sorted((i, k, v) for k, (i, v) in diff.items() if v is not None): items.insert(i, (k, v))
+            d = dict(items)
+            if name == 'palette': palette = d
+            else: custom = d
+        return quantized, palette, custom, box
+
+    def _snapshot_top(self):
+        # Antes de trocar a imagem inteira (regeração), o topo vira um snapshot completo
+        if not self.history or 'snapshot' in self.history[-1] or not self.quantized: return
+        top = self.history.pop()
+        self.history_bytes -= top['bytes']
+        q, p, c, _ = self._apply_entry(top, self.quantized.copy(), dict(self.palette), dict(self.custom_palette))
+        size = _ENTRY_OVERHEAD + q.width * q.height + 48 * (len(p) + len(c))
+        self._push_history({'snapshot': {'quantized': q, 'palette': p, 'custom_palette': c}, 'bytes': size})
 
     def undo(self):
         if not self.history: return
         s = self.history.pop()
-        self.quantized = s['quantized']; self.palette = s['palette']; self.custom_palette = s['custom_palette']
-        self._draw_grid()
+        self.history_bytes -= s['bytes']
+        self.quantized, self.palette, self.custom_palette, box = self._apply_entry(s, self.quantized, self.palette, self.custom_palette)
+        if box or 'snapshot' in s: self._mark_dirty("quantized")
+        if 'snapshot' in s or 'palette' in s: self._draw_grid()
+        elif box: self._draw_cells(*box)
 
-    def load_image(self, file_bytes: bytes) -> None:
-        self.original = Image.open(io.BytesIO(file_bytes)).convert("RGB")
-        self.history = []
+    def load_image(self, source) -> None:
+        # source: bytes ou arquivo binário (lido aos poucos pelo decodificador)
+        self.original = _open_image(io.BytesIO(source) if isinstance(source, bytes) else source)
+        self._mark_dirty("original")
+        self.history = []; self.history_bytes = 0
 
-    def generate_grid(self) -> None:
-        if not self.original: return
-        img = self.original.copy()
+    # generate_grid em etapas (ajustes -> resize -> quantização); cada etapa só é refeita
+    # quando muda algum parâmetro do qual ela (ou uma etapa anterior) depende.
+    def _stage(self, name: str, key: Tuple, build) -> Image.Image:
+        cached = self._stages.get(name)
+        if cached and cached[0] == key: return cached[1]
+        with timed(f"generate_grid.{name}"): value = build()
+        self._stages[name] = (key, value)
+        return value
+
+    def _adjust(self) -> Image.Image:
+        img = self.original
         if self.posterize < 8: img = ImageOps.posterize(img, max(1, min(8, int(self.posterize))))
-        if self.gamma != 1.0: img = img.point([int(((i/255.0)**(1.0/self.gamma))*255) for i in range(256)]*3)
+        if self.gamma != 1.0: img = img.point(_gamma_table(self.gamma))
         if self.saturation != 1.0: img = ImageEnhance.Color(img).enhance(self.saturation)
         if self.brightness != 1.0: img = ImageEnhance.Brightness(img).enhance(self.brightness)
         if self.contrast != 1.0: img = ImageEnhance.Contrast(img).enhance(self.contrast)
+        return img
 
+    def _resize(self, img: Image.Image) -> Image.Image:
         ratio = self.gauge_stitches / max(1, self.gauge_rows)
         w, h = img.size
         new_w = max(10, self.grid_width_cells)
         new_h = int((h / w) * new_w * ratio)
-        
-        self.processed = img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-        self.quantized = self.processed.quantize(colors=self.max_colors, method=Image.MEDIANCUT, dither=Image.FLOYDSTEINBERG)
-        
+        return img.resize((new_w, new_h), Image.Resampling.LANCZOS)
+
+    def generate_grid(self) -> None:
+        if not self.original: return
+        adjust_key = (self.posterize, self.gamma, self.saturation, self.brightness, self.contrast)
+        img = self._stage("adjust", adjust_key, self._adjust)
+        resize_key = adjust_key + (self.grid_width_cells, self.gauge_stitches, self.gauge_rows)
+        self.processed = self._stage("resize", resize_key, lambda: self._resize(img))
+        quantized = self._stage("quantize", resize_key + (self.max_colors,),
+                                lambda: self.processed.quantize(colors=self.max_colors, method=Image.MEDIANCUT, dither=Image.FLOYDSTEINBERG))
+        self._snapshot_top()
+        self.quantized = quantized.copy()
+
         raw = self.quantized.getpalette()[:self.max_colors * 3]
         base = {i: (raw[i*3], raw[i*3+1], raw[i*3+2]) for i in range(self.max_colors) if i*3+2 < len(raw)}
         self.palette = {i: self.custom_palette.get(i, c) for i, c in base.items()}
+        self._mark_dirty("quantized")
         self._draw_grid()
 
+    def _render_lut(self) -> np.ndarray:
+        if self.show_grid: return palette_lut(self.palette)
+        # Prévia sem grade usa a paleta embutida na imagem (igual ao resize do P)
+        raw = (self.quantized.getpalette() or [])[:768]
+        lut = np.zeros(768, dtype=np.uint8); lut[:len(raw)] = raw
+        return lut.reshape(256, 3)
+
     def _draw_grid(self) -> None:
         if not self.quantized: return
-        margin = 50
         wc, hc = self.quantized.size
-        total_w = margin + wc * self.cell_size + 20
-        total_h = margin + hc * self.cell_size + 20
-        
-        if not self.show_grid:
-            base = Image.new("RGBA", (total_w, total_h), (255, 255, 255, 255))
-            prev = self.quantized.resize((wc * self.cell_size, hc * self.cell_size), Image.Resampling.NEAREST)
-            base.paste(prev, (margin, margin))
-            self.grid_image = base.convert("RGB")
-            return
-
-        base = Image.new("RGBA", (total_w, total_h), (255, 255, 255, 255))
-        draw = ImageDraw.Draw(base)
-        for y in range(hc):
-            for x in range(wc):
-                color = self.palette.get(self.quantized.getpixel((x, y)), (255, 255, 255))
-                px, py = margin + x * self.cell_size, margin + y * self.cell_size
-                draw.rectangle([px, py, px + self.cell_size, py + self.cell_size], fill=color)
-
-        overlay = Image.new("RGBA", (total_w, total_h), (255, 255, 255, 0))
-        d_ov = ImageDraw.Draw(overlay)
-        for y in range(hc + 1):
-            py = margin + y * self.cell_size
-            thk = (y % 10 == 0 or y == 0 or y == hc)
-            d_ov.line([(margin, py), (margin + wc * self.cell_size, py)], fill=(255,255,255,180 if thk else 70), width=2 if thk else 1)
-        for x in range(wc + 1):
-            px = margin + x * self.cell_size
-            thk = (x % 10 == 0 or x == 0 or x == wc)
-            d_ov.line([(px, margin), (px, margin + hc * self.cell_size)], fill=(255,255,255,180 if thk else 70), width=2 if thk else 1)
-            
-        combined = Image.alpha_composite(base, overlay)
-        d_comb = ImageDraw.Draw(combined)
-        for x in range(wc):
-            if (x+1)%5==0 or x==0: d_comb.text((margin + x*self.cell_size + 11, 25), str(x+1), fill=(100,100,100), anchor="mm")
-        for y in range(hc):
-            if (y+1)%5==0 or y==0: d_comb.text((20, margin + y*self.cell_size + 11), str(y+1), fill=(100,100,100), anchor="mm")
-        self.grid_image = combined.convert("RGB")
+        with timed("draw_grid"):
+            layers = grid_layers(wc, hc, self.cell_size, bool(self.show_grid))
+            self.grid_image = layers.render(np.asarray(self.quantized), self._render_lut())
+
+    def _draw_cells(self, x0: int, y0: int, x1: int, y1: int) -> None:
+        # Redesenho incremental sobre o grid_image já renderizado (só as células sujas)
+        self._draw_boxes([(x0, y0, x1, y1)])
+
+    def _draw_boxes(self, boxes: List[Tuple[int, int, int, int]]) -> None:
+        # Vários retângulos de células numa passada: uma LUT, uma leitura dos índices e uma versão
+        if not self.quantized: return
+        wc, hc = self.quantized.size
+        boxes = [(max(0, x0), max(0, y0), min(wc, x1), min(hc, y1)) for x0, y0, x1, y1 in boxes]
+        boxes = [b for b in boxes if b[0] < b[2] and b[1] < b[3]]
+        if not boxes: return
+        if self._grid_image is None: return  # ainda não renderizado: sai completo no primeiro uso
+        layers = grid_layers(wc, hc, self.cell_size, bool(self.show_grid))
+        if self._grid_image.size != layers.size: return self._draw_grid()
+        cells, lut = np.asarray(self.quantized), self._render_lut()
+        for box in boxes:
+            pos, patch = layers.render_region(cells, lut, *box)
+            self.grid_image.paste(patch, pos)
+        self._bump_version()
+
+    def _remap_indices(self, mapping: Dict[int, int]) -> None:
+        # Remapeamento de todos os pixels em uma passada C (tabela de 256 entradas)
+        lut = list(range(256))
+        for f, t in mapping.items(): lut[f] = t
+        self.quantized = self.quantized.point(lut)
+        self._mark_dirty("quantized")
+
+    def _histogram(self) -> List[int]:
+        if self._hist is None or self._hist[0] != self.version: self._hist = (self.version, self.quantized.histogram())
+        return self._hist[1]
+
+    def _analysis(self) -> PaletteAnalysis:
+        return palette_analysis(tuple((k, tuple(c)) for k, c in self.palette.items()))
+
+    def _index_usage(self) -> List[Tuple[int, int]]:
+        # (índice, contagem) na ordem da 1ª ocorrência, como a varredura linha a linha
+        counts = self._histogram()
+        vals, first = np.unique(np.asarray(self.quantized), return_index=True)
+        return [(int(v), counts[v]) for _, v in sorted(zip(first, vals))]
 
     def get_palette_info(self) -> List[Dict]:
         if not self.quantized: return []
-        usage = defaultdict(int)
-        w, h = self.quantized.size
-        for y in range(h):
-            for x in range(w):
-                if self.quantized.getpixel((x, y)) in self.palette: usage[self.quantized.getpixel((x, y))] += 1
-        return [{"index": i, "hex": f"#{r:02x}{g:02x}{b:02x}", "count": c} for i, c in sorted(usage.items(), key=lambda x: -x[1]) if i in self.palette]
+        usage = [(i, c) for i, c in self._index_usage() if i in self.palette]
+        return [{"index": i, "hex": f"#{r:02x}{g:02x}{b:02x}", "count": c} for i, c in sorted(usage, key=lambda x: -x[1]) for r, g, b in [self.palette[i]]]
 
     def paint_cell(self, x, y, idx):
         if not self.quantized or idx not in self.palette: return
-        self._save_state()
-        if 0 <= x < self.quantized.width and 0 <= y < self.quantized.height:
-            self.quantized.putpixel((x, y), idx)
-            self._draw_grid()
+        inside = 0 <= x < self.quantized.width and 0 <= y < self.quantized.height
+        self._save_state(cells=([y * self.quantized.width + x], self.quantized.getpixel((x, y))) if inside else None)
+        if inside:
+            self.quantized.putpixel((x, y), idx); self._mark_dirty("quantized")
+            self._draw_cells(x, y, x + 1, y + 1)
 
     def replace_color(self, idx, hex_val):
-        self._save_state()
+        self._save_state(keys=(idx,))
         self.custom_palette[idx] = self.palette[idx] = (int(hex_val[1:3],16), int(hex_val[3:5],16), int(hex_val[5:7],16))
         self._draw_grid()
 
     def delete_color(self, idx):
-        self._save_state()
-        c1 = self.palette[idx]
-        best, min_d = None, float('inf')
-        for i, c2 in self.palette.items():
-            if i == idx: continue
-            d = math.sqrt(sum((a-b)**2 for a,b in zip(c1,c2)))
-            if d < min_d: min_d, best = d, i
+        if idx not in self.palette: raise KeyError(idx)
+        best = self._analysis().nearest(idx)
+        cells, keys = None, ()
+        if best is not None: cells, keys = (np.flatnonzero(np.asarray(self.quantized) == idx), idx), (idx,)
+        self._save_state(cells, keys)
         if best is not None:
-            w, h = self.quantized.size
-            for y in range(h):
-                for x in range(w):
-                    if self.quantized.getpixel((x,y)) == idx: self.quantized.putpixel((x,y), best)
+            self._remap_indices({idx: best})
             self.palette.pop(idx, None); self.custom_palette.pop(idx, None); self._draw_grid()
 
     def merge_colors(self, f, t):
-        self._save_state()
-        w, h = self.quantized.size
-        for y in range(h):
-            for x in range(w):
-                if self.quantized.getpixel((x,y)) == f: self.quantized.putpixel((x,y), t)
+        self._save_state(cells=(np.flatnonzero(np.asarray(self.quantized) == f), f), keys=(f,))
+        self._remap_indices({f: t})
         self.palette.pop(f, None); self.custom_palette.pop(f, None); self._draw_grid()
         
     def get_pixel_index(self, x, y): return int(self.quantized.getpixel((x,y))) if self.quantized and 0<=x<self.quantized.width and 0<=y<self.quantized.height else -1
 
     def replace_index_in_region(self, x, y, w, h, f, t):
         if not self.quantized: return
-        self._save_state()
-        for py in range(max(0,y), min(self.quantized.height, y+h)):
-            for px in range(max(0,x), min(self.quantized.width, x+w)):
-                if self.quantized.getpixel((px,py)) == f: self.quantized.putpixel((px,py), t)
-        self._draw_grid()
+        x0, y0, x1, y1 = max(0,x), max(0,y), min(self.quantized.width, x+w), min(self.quantized.height, y+h)
+        if x0 >= x1 or y0 >= y1: return self._save_state()
+        sub = np.asarray(self.quantized.crop((x0, y0, x1, y1)))
+        hit = sub == f
+        ys, xs = np.nonzero(hit)
+        self._save_state(cells=((ys + y0) * self.quantized.width + xs + x0, f))
+        if not ys.size: return
+        sub = np.where(hit, t, sub).astype(np.uint8)
+        self.quantized.paste(Image.frombytes("P", (x1-x0, y1-y0), sub.tobytes()), (x0, y0))
+        self._mark_dirty("quantized")
+        self._draw_cells(x0, y0, x1, y1)
+
+    # Lote de edições (traço do pincel, baldes, uniões, trocas de cor) aplicado sobre uma cópia
+    # dos índices: uma entrada de histórico, um redesenho e uma gravação para o lote inteiro.
+    def apply_edits(self, ops: List[Dict[str, Any]]) -> Dict[str, Any]:
+        if not self.quantized: return {"cells": [], "palette_changed": False}
+        before = np.asarray(self.quantized)
+        cells = before.copy()
+        h, w = cells.shape
+        palette, custom = dict(self.palette), dict(self.custom_palette)
+        keys: List[int] = []
+
+        def in_palette(*idx: int) -> None:
+            # Contra a paleta de trabalho (já com as operações anteriores do lote); nada foi aplicado ainda
+            for i in idx:
+                if i not in palette: raise ValueError(f"Cor {i} não está na paleta")
+
+        for op in ops:
+            kind = op.get("op")
+            if kind == "paint":
+                x, y, idx = op["x"], op["y"], op["color_index"]
+                in_palette(idx)
+                if 0 <= x < w and 0 <= y < h: cells[y, x] = idx
+            elif kind == "region":
+                x, y = op["x"], op["y"]
+                in_palette(op["from_index"], op["to_index"])
+                sub = cells[max(0, y):max(0, y + op["h"]), max(0, x):max(0, x + op["w"])]
+                sub[sub == op["from_index"]] = op["to_index"]
+            elif kind == "merge":
+                f = op["from_index"]
+                in_palette(f, op["to_index"])
+                if f == op["to_index"]: raise ValueError(f"Não dá para unir a cor {f} com ela mesma")
+                cells[cells == f] = op["to_index"]
+                palette.pop(f, None); custom.pop(f, None); keys.append(f)
+            elif kind == "replace_color":
+                idx, hex_val = op["index"], op["new_hex"]
+                custom[idx] = palette[idx] = (int(hex_val[1:3],16), int(hex_val[3:5],16), int(hex_val[5:7],16))
+                keys.append(idx)
+            else:
+                raise ValueError(f"Operação desconhecida: {kind}")
+
+        changed = np.flatnonzero(cells != before)
+        keys = list(dict.fromkeys(keys))
+        self._save_state(cells=(changed, before.ravel()[changed]), keys=tuple(keys))
+        if changed.size:
+            ys, xs = changed // w, changed % w
+            x0, y0, x1, y1 = int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+            self.quantized.paste(Image.frombytes("P", (x1 - x0, y1 - y0), cells[y0:y1, x0:x1].tobytes()), (x0, y0))
+            self._mark_dirty("quantized")
+        self.palette, self.custom_palette = palette, custom
+        if keys or changed.size > 64: self._draw_grid()
+        elif changed.size:
+            # Um redesenho para o lote: o retângulo envolvente se for pequeno, senão só as células alteradas
+            if (x1 - x0) * (y1 - y0) <= 64: self._draw_boxes([(x0, y0, x1, y1)])
+            else: self._draw_boxes([(x, y, x + 1, y + 1) for y, x in zip(ys.tolist(), xs.tolist())])
+        return {"cells": [[int(x), int(y)] for y, x in zip(*divmod(changed, w))], "palette_changed": bool(keys)}
+
+    def update_params(self, values: Dict[str, Any]) -> None:
+        if not values.keys() <= _VIEW_PARAMS: self._save_state()
+        for k, v in values.items(): setattr(self, k, v)
+        if values.get("show_grid") is not None: self._draw_grid()
+
+    def get_original_base64(self) -> str:
+        if not self.original: return ""
+        buf = io.BytesIO(); self.original.save(buf, "PNG"); return base64.b64encode(buf.getvalue()).decode()
+
+    def grid_etag(self, *parts: int) -> str:
+        self.grid_image  # renderiza (e sobe a versão) se ainda não houver imagem
+        return '"' + "-".join(map(str, (self.epoch, self.version, self.highlighted_row) + parts)) + '"'
+
+    def _cached_png(self, key: Tuple[int, ...], build) -> bytes:
+        data = self._png.get(key)
+        if data is not None:
+            self._png.move_to_end(key)
+            return data
+        with timed("grid_png"): buf = io.BytesIO(); build().save(buf, "PNG"); data = buf.getvalue()
+        self._png[key] = data; self._png_bytes += len(data)
+        while len(self._png) > 1 and self._png_bytes > PNG_CACHE_BYTES:
+            self._png_bytes -= len(self._png.popitem(last=False)[1])
+        return data
+
+    def get_grid_png(self) -> bytes:
+        img, row = self.grid_image, self.highlighted_row
+        if not img: return b""
+        return self._cached_png((row,), lambda: _highlight_row(img, row, self.cell_size) if row >= 0 else img)
+
+    def get_grid_tile(self, tx: int, ty: int) -> Optional[bytes]:
+        # Bloco GRID_TILE x GRID_TILE da grade renderizada (o custo cresce com o bloco, não com a grade)
+        img, row = self.grid_image, self.highlighted_row
+        if not img or tx < 0 or ty < 0 or tx * GRID_TILE >= img.width or ty * GRID_TILE >= img.height: return None
+        def build():
+            box = (tx * GRID_TILE, ty * GRID_TILE, min(img.width, (tx + 1) * GRID_TILE), min(img.height, (ty + 1) * GRID_TILE))
+            tile = img.crop(box)
+            return _highlight_row(tile, row, self.cell_size, box[1]) if row >= 0 else tile
+        return self._cached_png((row, tx, ty), build)
+
+    def _sync_cell_versions(self) -> np.ndarray:
+        cur = np.asarray(self.quantized)
+        if self._shadow is None or self._shadow.shape != cur.shape:
+            self._cell_ver = np.full(cur.shape, self.version, dtype=np.uint32)
+            self._cells_base = self.version
+        else:
+            self._cell_ver[cur != self._shadow] = self.version
+        self._shadow = cur
+        return cur
+
+    def get_cells(self, since: Optional[int] = None, epoch: Optional[str] = None, encoding: str = "auto") -> bytes:
+        """Matriz de índices + paleta efetiva + versão; delta quando `since`/`epoch` ainda valem."""
+        if not self.quantized: return b""
+        cur = self._sync_cell_versions()
+        h, w = cur.shape
+        flat = cur.ravel()
+        used = sorted(set(self.palette) | set(np.flatnonzero(np.bincount(flat, minlength=256)).tolist()))
+        pal = np.column_stack([used, self._render_lut()[used]]).astype(np.uint8).tobytes()
+
+        kind, body = None, b""
+        if since is not None and epoch == self.epoch and self._cells_base <= since <= self.version:
+            pos = np.flatnonzero(self._cell_ver.ravel() > since)
+            if pos.size * 5 < flat.size:
+                kind, body = WIRE_DELTA, struct.pack("<I", pos.size) + pos.astype("<u4").tobytes() + flat[pos].tobytes()
+        if kind is None:
+            kind, body = WIRE_RAW, flat.tobytes()
+            if encoding != "raw":
+                rle = _rle(flat)
+                if encoding == "rle" or len(rle) < len(body): kind, body = WIRE_RLE, rle
+        return _WIRE_HEADER.pack(_WIRE_MAGIC, kind, len(used), w, h, self.version, self.epoch.encode()) + pal + body
 
     def get_grid_base64(self) -> str:
-        if not self.grid_image: return ""
-        img = self.grid_image.copy()
-        if self.highlighted_row >= 0:
-            ov = Image.new("RGBA", img.size, (0,0,0,0)); d = ImageDraw.Draw(ov)
-            d.rectangle([0,0,img.width, img.height], fill=(0,0,0,100))
-            py = 50 + (self.highlighted_row-1)*self.cell_size
-            d.rectangle([0,0,img.width, py], fill=(0,0,0,160))
-            d.rectangle([0, py+self.cell_size, img.width, img.height], fill=(0,0,0,160))
-            img = Image.alpha_composite(img.convert("RGBA"), ov).convert("RGB")
-        buf = io.BytesIO(); img.save(buf, "PNG"); return base64.b64encode(buf.getvalue()).decode()
+        return base64.b64encode(self.get_grid_png()).decode()
     
-    def suggest_clusters(self, threshold=50.0):
-        if not self.palette: return []
-        colors = list(self.palette.items())
-        groups = []
-        visited = set()
-        for i in range(len(colors)):
-            idx1, rgb1 = colors[i]
-            if idx1 in visited: continue
-            grp = [idx1]
-            for j in range(i+1, len(colors)):
-                idx2, rgb2 = colors[j]
-                if idx2 in visited: continue
-                if math.sqrt(sum((a-b)**2 for a,b in zip(rgb1,rgb2))) < threshold:
-                    grp.append(idx2); visited.add(idx2)
-            if len(grp) > 1: visited.add(idx1); groups.append(grp)
-        return groups
+    def suggest_clusters(self, threshold=CLUSTER_THRESHOLD):
+        if not self.palette or not self.quantized: return []
+        return self._analysis().clusters(threshold, self._histogram())
+
+    def cluster_levels(self, thresholds=CLUSTER_LEVELS) -> List[Dict[str, Any]]:
+        # Sugestões para vários limiares de uma vez (o modal varre o limiar sem voltar ao servidor)
+        if not self.palette or not self.quantized: return []
+        analysis, counts = self._analysis(), self._histogram()
+        return [{"threshold": t, "clusters": analysis.clusters(t, counts)} for t in thresholds]
+
+class SessionCache:
+    """Sessões ativas em ordem LRU, limitadas por memória e por tempo ocioso.
+
+    Sessões despejadas são gravadas em DATA_DIR e voltam via load_from_disk no próximo acesso.
+    O lock global só cobre a escolha/remoção das vítimas: gravação e leitura em disco ficam fora
+    dele, e sessões com trabalho na fila ou rodando (`is_busy`) não são despejadas.
+    O total em memória é mantido por sessão: remedido ao tocar (get/put/update) e descontado no despejo.
+    """
+
+    def __init__(self, budget_bytes: int = SESSION_CACHE_BYTES, idle_ttl: float = SESSION_IDLE_TTL):
+        self.budget_bytes = budget_bytes
+        self.idle_ttl = idle_ttl
+        self._items: "OrderedDict[str, TramaGridSession]" = OrderedDict()
+        self._last_used: Dict[str, float] = {}
+        self._sizes: Dict[str, int] = {}
+        self._total = 0
+        # Despejadas ainda sendo gravadas -> [sessão, gravações pendentes]; um acesso nesse meio-tempo
+        # reaproveita a sessão em vez de ler um disco possivelmente velho
+        self._evicting: Dict[str, List[Any]] = {}
+        self._lock = threading.RLock()
+        self.is_busy: Callable[[str], bool] = lambda sid: False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int: return len(self._items)
+
+    def __contains__(self, sid: str) -> bool: return sid in self._items
+
+    def get(self, sid: str) -> Optional[TramaGridSession]:
+        with self._lock:
+            s = self._items.get(sid) or self._evicting.get(sid, [None])[0]
+            if s is not None:
+                self.hits += 1
+                self._items[sid] = s
+                self._touch(sid)
+                victims = self._enforce(keep=sid)
+            else: self.misses += 1
+        if s is not None:
+            self._flush(victims)
+            return s
+
+        loaded = TramaGridSession()
+        if not loaded.load_from_disk(sid): return None
+        with self._lock:
+            # Outra thread pode ter carregado/criado a mesma sessão enquanto lia o disco
+            s = self._items.get(sid) or self._evicting.get(sid, [None])[0] or loaded
+            self._items[sid] = s
+            self._touch(sid)
+            victims = self._enforce(keep=sid)
+        self._flush(victims)
+        return s
+
+    def put(self, sid: str, s: TramaGridSession) -> None:
+        with self._lock:
+            self._items[sid] = s
+            self._touch(sid)
+            victims = self._enforce(keep=sid)
+        self._flush(victims)
+
+    def update(self, sid: str) -> None:
+        """Remede a sessão depois de um trabalho (upload, geração...) e despeja outras se passou do orçamento."""
+        with self._lock:
+            if sid not in self._items: return
+            self._touch(sid)
+            victims = self._enforce(keep=sid)
+        self._flush(victims)
+
+    def _touch(self, sid: str) -> None:
+        self._items.move_to_end(sid)
+        self._last_used[sid] = time.monotonic()
+        size = self._items[sid].memory_bytes()
+        self._total += size - self._sizes.get(sid, 0)
+        self._sizes[sid] = size
+
+    def _enforce(self, keep: str) -> List[Tuple[str, TramaGridSession]]:
+        # Só escolhe e remove as vítimas (chamado com o lock); quem chamou grava via _flush
+        now = time.monotonic()
+        victims = []
+        for sid in list(self._items):
+            if sid == keep or self.is_busy(sid): continue
+            if self._total <= self.budget_bytes and now - self._last_used[sid] < self.idle_ttl: break
+            s = self._items.pop(sid)
+            self._last_used.pop(sid, None)
+            self._total -= self._sizes.pop(sid, 0)
+            self._evicting.setdefault(sid, [s, 0])[1] += 1
+            self.evictions += 1
+            victims.append((sid, s))
+        return victims
+
+    def _flush(self, victims: List[Tuple[str, TramaGridSession]]) -> None:
+        for sid, s in victims:
+            try: s.save_to_disk(sid)
+            except Exception as e: print(f"⚠️ Falha ao gravar sessão {sid} no despejo: {e}")
+            finally:
+                with self._lock:
+                    entry = self._evicting[sid]
+                    entry[1] -= 1
+                    if not entry[1]: del self._evicting[sid]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            items = self._items.values()
+            return {"sessions": len(self._items), "bytes": self._total,
+                    "history_bytes": sum(s.history_bytes for s in items), "png_cache_bytes": sum(s._png_bytes for s in items),
+                    "budget_bytes": self.budget_bytes, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+class SessionWriter:
+    """Gravação em segundo plano: alterações de uma sessão dentro de `delay` viram uma única escrita."""
+
+    def __init__(self, delay: float = PERSIST_DELAY):
+        self.delay = delay
+        self._pending: Dict[str, Tuple[TramaGridSession, float]] = {}
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def schedule(self, sid: str, s: TramaGridSession) -> None:
+        with self._cond:
+            if self.delay > 0 and not self._stopped:
+                due = self._pending[sid][1] if sid in self._pending else time.monotonic() + self.delay
+                self._pending[sid] = (s, due)
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="session-writer", daemon=True)
+                    self._thread.start()
+                self._cond.notify()
+                return
+        self._write(sid, s)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if self._stopped: return
+                if not self._pending: self._cond.wait(); continue
+                sid, (s, due) = min(self._pending.items(), key=lambda kv: kv[1][1])
+                wait = due - time.monotonic()
+                if wait > 0: self._cond.wait(wait); continue
+                del self._pending[sid]
+            self._write(sid, s)
+
+    def _write(self, sid: str, s: TramaGridSession) -> None:
+        try: s.save_to_disk(sid)
+        except Exception as e: print(f"⚠️ Falha ao gravar sessão {sid}: {e}")
+
+    def pending(self) -> int:
+        with self._cond: return len(self._pending)
+
+    def flush(self) -> None:
+        with self._cond: items, self._pending = list(self._pending.items()), {}
+        for sid, (s, _) in items: self._write(sid, s)
+
+    def stop(self) -> None:
+        with self._cond: self._stopped = True; self._cond.notify_all()
+        self.flush()
+
+class SessionExecutor:
+    """Roda o trabalho das sessões num pool de threads, fora do event loop.
+
+    Tarefas da mesma sessão entram em ordem de chegada (asyncio.Lock é FIFO) e nunca rodam em paralelo;
+    acima de `max_pending` tarefas no total, responde 503 com Retry-After.
+    """
+
+    def __init__(self, workers: int = WORKER_THREADS, max_pending: int = MAX_PENDING_TASKS):
+        self.max_pending = max_pending
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tramagrid")
+        self._locks: Dict[str, List[Any]] = {}
+        self._pending = 0
+
+    @property
+    def pending(self) -> int: return self._pending
+
+    def busy(self, sid: str) -> bool: return sid in self._locks
+
+    async def run(self, sid: str, fn, persist: bool = False) -> Any:
+        if self._pending >= self.max_pending:
+            raise HTTPException(503, "Servidor ocupado, tente novamente.", headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+        self._pending += 1
+        entry = self._locks.setdefault(sid, [asyncio.Lock(), 0]); entry[1] += 1
+        try:
+            async with entry[0]:
+                # copy_context: as etapas cronometradas na thread entram no Server-Timing da requisição
+                ctx = contextvars.copy_context()
+                return await asyncio.get_running_loop().run_in_executor(self._pool, ctx.run, self._call, sid, fn, persist)
+        finally:
+            self._pending -= 1; entry[1] -= 1
+            if not entry[1]: self._locks.pop(sid, None)
+
+    async def edit(self, sid: str, fn) -> Dict[str, bool]:
+        await self.run(sid, fn, persist=True); return {"ok": True}
+
+    @staticmethod
+    def _call(sid: str, fn, persist: bool) -> Any:
+        s = get_session_or_load(sid)
+        with s.lock:
+            result = fn(s)
+            if persist: writer.schedule(sid, s)
+        sessions.update(sid)
+        return result
+
+    def shutdown(self) -> None: self._pool.shutdown(wait=True)
+
+sessions = SessionCache()
+writer = SessionWriter()
+executor = SessionExecutor()
+sessions.is_busy = executor.busy
+
+# ================= CRÉDITOS (LEDGER) =================
+# Consumir e recarregar créditos são uma única operação condicional no banco (funções SQL de
+# credit_ledger.sql, chamadas via PostgREST com conexões HTTP reaproveitadas). A recarga é
+# idempotente pelo id do evento do Stripe. TRAMAGRID_LEDGER=local troca por um ledger em
+# memória com a mesma semântica, para testes de carga e de correção sem Supabase.
+LEDGER_BACKEND = os.getenv("TRAMAGRID_LEDGER", "supabase")
+LEDGER_MAX_CONNECTIONS = int(os.getenv("TRAMAGRID_LEDGER_CONNECTIONS", "20"))
+LEDGER_TIMEOUT = float(os.getenv("TRAMAGRID_LEDGER_TIMEOUT", "10"))
+
+# Resultados de CreditLedger.consume (os mesmos textos que a função SQL consume_credit devolve)
+CREDIT_FREE, CREDIT_PAID, CREDIT_INSUFFICIENT, CREDIT_NOT_FOUND = "free", "credit", "insufficient", "not_found"
+
+class CreditLedger(abc.ABC):
+    """Saldo de créditos por usuário; cada chamada é atômica no armazenamento."""
+
+    @abc.abstractmethod
+    async def consume(self, user_id: str) -> str:
+        """Gasta a geração grátis ou, se já usada, 1 crédito. Devolve um dos CREDIT_*."""
+
+    @abc.abstractmethod
+    async def add(self, user_id: str, amount: int, event_id: str) -> bool:
+        """Soma `amount` créditos uma única vez por `event_id`; False se o evento já foi aplicado.
+        Falha (sem registrar o evento) se o perfil não existir, para o pagamento não se perder."""
+
+    async def close(self) -> None: pass
+
+class SupabaseLedger(CreditLedger):
+    def __init__(self, url: str, key: str, max_connections: int = LEDGER_MAX_CONNECTIONS, timeout: float = LEDGER_TIMEOUT):
+        self._client = httpx.AsyncClient(
+            base_url=f"{url.rstrip('/')}/rest/v1", timeout=timeout,
+            headers={"apikey": key, "Authorization": f"Bearer {key}", "Content-Type": "application/json"},
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+
+    async def _rpc(self, fn: str, args: Dict[str, Any]) -> Any:
+        res = await self._client.post(f"/rpc/{fn}", json=args)
+        res.raise_for_status()
+        return res.json()
+
+    async def consume(self, user_id: str) -> str:
+        return await self._rpc("consume_credit", {"p_user_id": user_id})
+
+    async def add(self, user_id: str, amount: int, event_id: str) -> bool:
+        return bool(await self._rpc("add_credits", {"p_user_id": user_id, "p_amount": amount, "p_event_id": event_id}))
+
+    async def close(self) -> None: await self._client.aclose()
+
+class LocalLedger(CreditLedger):
+    """Ledger em memória. Com `initial_credits`, usuários desconhecidos são criados na hora
+    (como o frontend faz no primeiro login), com esse saldo e a geração grátis disponível."""
+
+    def __init__(self, profiles: Optional[Dict[str, Dict[str, Any]]] = None, initial_credits: Optional[int] = None):
+        self.profiles: Dict[str, Dict[str, Any]] = profiles if profiles is not None else {}
+        self.events: Dict[str, Tuple[str, int]] = {}
+        self.initial_credits = initial_credits
+        self._lock = threading.Lock()
+
+    def _profile(self, user_id: str) -> Optional[Dict[str, Any]]:
+        p = self.profiles.get(user_id)
+        if p is None and self.initial_credits is not None:
+            p = self.profiles[user_id] = {"credits": self.initial_credits, "free_generation_used": False}
+        return p
+
+    async def consume(self, user_id: str) -> str:
+        with self._lock:
+            p = self._profile(user_id)
+            if p is None: return CREDIT_NOT_FOUND
+            if not p.get("free_generation_used"):
+                p["free_generation_used"] = True
+                return CREDIT_FREE
+            if (p.get("credits") or 0) > 0:
+                p["credits"] -= 1
+                return CREDIT_PAID
+            return CREDIT_INSUFFICIENT
+
+    async def add(self, user_id: str, amount: int, event_id: str) -> bool:
+        with self._lock:
+            if event_id in self.events: return False
+            p = self._profile(user_id)
+            if p is None: raise LookupError(f"perfil {user_id} não encontrado")
+            p["credits"] = (p.get("credits") or 0) + amount
+            self.events[event_id] = (user_id, amount)
+            return True
+
+def make_ledger() -> Optional[CreditLedger]:
+    if LEDGER_BACKEND == "local":
+        print("🧪 Ledger de créditos local (em memória).")
+        return LocalLedger(initial_credits=int(os.getenv("TRAMAGRID_LOCAL_CREDITS", "0")))
+    if SUPABASE_URL and SUPABASE_SERVICE_KEY: return SupabaseLedger(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+    return None
+
+ledger = make_ledger()
+
+class UploadSizeLimit:
+    """Recusa com 413 uploads acima do limite antes de o multipart ser lido e gravado em disco:
+    pelo Content-Length, ou contando os bytes do corpo à medida que chegam (envio chunked)."""
+
+    def __init__(self, app, limit: int, prefix: str = "/api/upload/"):
+        self.app, self.limit, self.prefix = app, limit, prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefix):
+            return await self.app(scope, receive, send)
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.limit:
+            return await JSONResponse({"detail": "Arquivo grande demais."}, status_code=413)(scope, receive, send)
+        received = 0
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            # Sobe pelo parser do formulário até o tratamento de HTTPException do FastAPI
+            if received > self.limit: raise HTTPException(413, "Arquivo grande demais.")
+            return message
+        await self.app(scope, limited_receive, send)
 
 # ==================== ROTAS API ====================
 app = FastAPI()
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(UploadSizeLimit, limit=MAX_UPLOAD_BYTES + _MULTIPART_SLACK)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"], expose_headers=["ETag", "X-Grid-Size", "Server-Timing"])
+
+if METRICS_ENABLED:
+    @app.middleware("http")
+    async def record_timing(request: Request, call_next):
+        timings: List[Tuple[str, float]] = []
+        token = _request_timings.set(timings)
+        t0 = time.perf_counter()
+        try: response = await call_next(request)
+        finally: _request_timings.reset(token)
+        dt = time.perf_counter() - t0
+        route = request.scope.get("route")  # modelo da rota (/api/grid/{sid}), não o caminho com o id
+        metrics.observe_route(request.method, getattr(route, "path", "unmatched"), response.status_code, dt)
+        response.headers["Server-Timing"] = ", ".join([f"{n};dur={d * 1e3:.1f}" for n, d in timings] + [f"total;dur={dt * 1e3:.1f}"])
+        return response
+
+@app.on_event("shutdown")
+def flush_sessions(): executor.shutdown(); writer.stop()
+
+@app.on_event("shutdown")
+async def close_ledger():
+    if ledger: await ledger.close()
 
 def get_session_or_load(sid: str) -> TramaGridSession:
-    if sid in sessions: return sessions[sid]
-    s = TramaGridSession()
-    if s.load_from_disk(sid): sessions[sid] = s; return s
-    raise HTTPException(404, "Sessão não encontrada.")
+    s = sessions.get(sid)
+    if s is None: raise HTTPException(404, "Sessão não encontrada.")
+    return s
 
 class ParamsUpdate(BaseModel):
     max_colors: int|None=None; grid_width_cells: int|None=None; brightness: float|None=None
@@ -298,92 +1390,148 @@ class ColRep(BaseModel): index: int; new_hex: str
 class ColDel(BaseModel): index: int
 class Merge(BaseModel): from_index: int; to_index: int
 class RegRep(BaseModel): x: int; y: int; w: int; h: int; from_index: int; to_index: int
+# Operações do lote: um modelo por tipo (campo "op"), todos os campos obrigatórios -> 422 se faltar algum
+ColorIndex = Annotated[int, Field(ge=0, le=255)]
+class PaintOp(BaseModel): op: Literal["paint"]; x: int; y: int; color_index: ColorIndex
+class RegionOp(BaseModel): op: Literal["region"]; x: int; y: int; w: int; h: int; from_index: ColorIndex; to_index: ColorIndex
+class MergeOp(BaseModel): op: Literal["merge"]; from_index: ColorIndex; to_index: ColorIndex
+class ReplaceColorOp(BaseModel): op: Literal["replace_color"]; index: ColorIndex; new_hex: str = Field(pattern=r"^#[0-9a-fA-F]{6}$")
+EditOp = Annotated[Union[PaintOp, RegionOp, MergeOp, ReplaceColorOp], Field(discriminator="op")]
+class EditBatch(BaseModel): ops: List[EditOp]
 class CheckoutSession(BaseModel): quantity: int; user_id: str
 class UserRequest(BaseModel): user_id: str # <--- IMPORTANTE PARA O V2.0
 
 @app.post("/api/session")
-def create_sess(): sid = str(uuid.uuid4()); sessions[sid] = TramaGridSession(); sessions[sid].save_to_disk(sid); return {"session_id": sid}
+def create_sess(): sid = str(uuid.uuid4()); s = TramaGridSession(); sessions.put(sid, s); writer.schedule(sid, s); return {"session_id": sid}
+
+@app.get("/metrics")
+def prometheus_metrics():
+    st = sessions.stats()
+    gauges = [
+        ("tramagrid_sessions_live", "gauge", "Sessões em memória.", st["sessions"]),
+        ("tramagrid_session_bytes", "gauge", "Memória estimada das sessões (imagens, histórico, PNGs).", st["bytes"]),
+        ("tramagrid_history_bytes", "gauge", "Bytes do histórico de desfazer.", st["history_bytes"]),
+        ("tramagrid_png_cache_bytes", "gauge", "Bytes dos PNGs da grade em cache.", st["png_cache_bytes"]),
+        ("tramagrid_image_bytes", "gauge", "Bytes das imagens e matrizes em memória.", st["bytes"] - st["history_bytes"] - st["png_cache_bytes"]),
+        ("tramagrid_session_cache_hits_total", "counter", "Sessões encontradas em memória.", st["hits"]),
+        ("tramagrid_session_cache_misses_total", "counter", "Sessões recarregadas do disco.", st["misses"]),
+        ("tramagrid_session_evictions_total", "counter", "Sessões despejadas da memória.", st["evictions"]),
+        ("tramagrid_tasks_pending", "gauge", "Tarefas de sessão na fila ou rodando.", executor.pending),
+        ("tramagrid_writes_pending", "gauge", "Sessões aguardando gravação.", writer.pending()),
+    ]
+    return Response(metrics.render(gauges), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/sessions/stats")
+def sess_stats(): return sessions.stats()
 
 @app.post("/api/upload/{sid}")
 async def up(sid: str, file: UploadFile = File(...)):
-    s = get_session_or_load(sid); s.load_image(await file.read()); s.generate_grid(); s.save_to_disk(sid); return {"ok": True}
+    # O multipart já chega em arquivo temporário (disco acima de 1 MB): decodifica direto dele.
+    # UploadSizeLimit já barrou corpos grandes demais; aqui vale o limite exato do arquivo
+    if (file.size or 0) > MAX_UPLOAD_BYTES: raise HTTPException(413, "Arquivo grande demais.")
+    def work(s: TramaGridSession):
+        try: s.load_image(file.file)
+        except Image.DecompressionBombError as e: raise HTTPException(413, str(e))
+        except (OSError, ValueError, SyntaxError): raise HTTPException(400, "Arquivo de imagem inválido.")
+        s.generate_grid()
+    return await executor.edit(sid, work)
 
 @app.post("/api/generate/{sid}")
-def gen(sid: str): s = get_session_or_load(sid); s.generate_grid(); s.save_to_disk(sid); return {"ok": True}
+async def gen(sid: str): return await executor.edit(sid, lambda s: s.generate_grid())
+
+def etag_matches(request: Request, tag: str) -> bool:
+    header = request.headers.get("if-none-match", "")
+    return header.strip() == "*" or tag in (t.strip().removeprefix("W/") for t in header.split(","))
 
 @app.get("/api/grid/{sid}")
-def grd(sid: str): return {"image_base64": get_session_or_load(sid).get_grid_base64()}
+async def grd(sid: str, request: Request):
+    # Sem mudança desde o último GET (mesma versão e linha destacada) -> 304 sem reprocessar
+    def work(s: TramaGridSession):
+        tag = s.grid_etag()
+        return tag, None if etag_matches(request, tag) else s.get_grid_base64()
+    tag, b64 = await executor.run(sid, work)
+    headers = {"ETag": tag, "Cache-Control": "no-cache"}
+    if b64 is None: return Response(status_code=304, headers=headers)
+    return JSONResponse({"image_base64": b64}, headers=headers)
+
+@app.get("/api/grid/tile/{sid}/{tx}/{ty}")
+async def tile(sid: str, tx: int, ty: int, request: Request):
+    def work(s: TramaGridSession):
+        tag = s.grid_etag(tx, ty)
+        size = s.grid_image.size if s.grid_image else (0, 0)
+        return tag, b"" if etag_matches(request, tag) else s.get_grid_tile(tx, ty), size
+    tag, png, size = await executor.run(sid, work)
+    headers = {"ETag": tag, "Cache-Control": "no-cache", "X-Grid-Size": f"{size[0]}x{size[1]}"}
+    if png is None: raise HTTPException(404, "Bloco fora da grade.")
+    if not png: return Response(status_code=304, headers=headers)
+    return Response(png, media_type="image/png", headers=headers)
+
+@app.get("/api/cells/{sid}")
+async def cells(sid: str, since: Optional[int] = None, epoch: Optional[str] = None, encoding: Literal["auto", "raw", "rle"] = "auto"):
+    data = await executor.run(sid, lambda s: s.get_cells(since, epoch, encoding))
+    return Response(data, media_type="application/octet-stream", headers={"Cache-Control": "no-store"})
 
 @app.get("/api/palette/{sid}")
-def pal(sid: str): return get_session_or_load(sid).get_palette_info()
+async def pal(sid: str): return await executor.run(sid, lambda s: s.get_palette_info())
 
 @app.post("/api/params/{sid}")
-def par(sid: str, d: ParamsUpdate):
-    s = get_session_or_load(sid); s._save_state()
-    for k,v in d.dict(exclude_unset=True).items(): setattr(s, k, v)
-    if d.show_grid is not None: s._draw_grid()
-    s.save_to_disk(sid); return {"ok": True}
+async def par(sid: str, d: ParamsUpdate): return await executor.edit(sid, lambda s: s.update_params(d.dict(exclude_unset=True)))
 
 @app.get("/api/params/{sid}")
-def gpar(sid: str): s = get_session_or_load(sid); return {k: getattr(s, k) for k in ["max_colors","grid_width_cells","brightness","contrast","saturation","gamma","posterize","gauge_stitches","gauge_rows","show_grid","highlighted_row"]}
+async def gpar(sid: str): return await executor.run(sid, lambda s: {k: getattr(s, k) for k in ["max_colors","grid_width_cells","brightness","contrast","saturation","gamma","posterize","gauge_stitches","gauge_rows","show_grid","highlighted_row"]})
 
 @app.post("/api/paint/{sid}")
-def pnt(sid: str, d: Paint): get_session_or_load(sid).paint_cell(d.x, d.y, d.color_index); get_session_or_load(sid).save_to_disk(sid); return {"ok":True}
+async def pnt(sid: str, d: Paint): return await executor.edit(sid, lambda s: s.paint_cell(d.x, d.y, d.color_index))
 
 @app.post("/api/query-pixel/{sid}")
-def qpx(sid: str, d: Pixel): return {"index": get_session_or_load(sid).get_pixel_index(d.x, d.y)}
+async def qpx(sid: str, d: Pixel): return await executor.run(sid, lambda s: {"index": s.get_pixel_index(d.x, d.y)})
 
 @app.post("/api/color/replace/{sid}")
-def cr(sid: str, d: ColRep): s=get_session_or_load(sid); s.replace_color(d.index, d.new_hex); s.save_to_disk(sid); return {"ok":True}
+async def cr(sid: str, d: ColRep): return await executor.edit(sid, lambda s: s.replace_color(d.index, d.new_hex))
 
 @app.post("/api/color/delete/{sid}")
-def cd(sid: str, d: ColDel): s=get_session_or_load(sid); s.delete_color(d.index); s.save_to_disk(sid); return {"ok":True}
+async def cd(sid: str, d: ColDel): return await executor.edit(sid, lambda s: s.delete_color(d.index))
 
 @app.post("/api/merge/{sid}")
-def mg(sid: str, d: Merge): s=get_session_or_load(sid); s.merge_colors(d.from_index, d.to_index); s.save_to_disk(sid); return {"ok":True}
+async def mg(sid: str, d: Merge): return await executor.edit(sid, lambda s: s.merge_colors(d.from_index, d.to_index))
 
 @app.post("/api/region/replace/{sid}")
-def rr(sid: str, d: RegRep): s=get_session_or_load(sid); s.replace_index_in_region(d.x,d.y,d.w,d.h,d.from_index,d.to_index); s.save_to_disk(sid); return {"ok":True}
+async def rr(sid: str, d: RegRep): return await executor.edit(sid, lambda s: s.replace_index_in_region(d.x,d.y,d.w,d.h,d.from_index,d.to_index))
+
+@app.post("/api/edits/{sid}")
+async def edt(sid: str, d: EditBatch):
+    # Lote inválido (cor fora da paleta de trabalho): 422 e a sessão fica como estava
+    try: return await executor.run(sid, lambda s: s.apply_edits([op.dict() for op in d.ops]), persist=True)
+    except ValueError as e: raise HTTPException(422, str(e))
 
 @app.post("/api/undo/{sid}")
-def und(sid: str): s=get_session_or_load(sid); s.undo(); s.save_to_disk(sid); return {"ok":True}
+async def und(sid: str): return await executor.edit(sid, lambda s: s.undo())
 
 @app.get("/api/clusters/{sid}")
-def clu(sid: str): return {"clusters": get_session_or_load(sid).suggest_clusters()}
+async def clu(sid: str, threshold: float = CLUSTER_THRESHOLD, levels: Optional[List[float]] = Query(None)):
+    return await executor.run(sid, lambda s: {"threshold": threshold, "clusters": s.suggest_clusters(threshold), "levels": s.cluster_levels(tuple(levels or CLUSTER_LEVELS))})
 
 @app.get("/api/original/{sid}")
-def ori(sid: str):
-    s = get_session_or_load(sid)
-    if not s.original: raise HTTPException(404, "Original não encontrada")
-    buf = io.BytesIO(); s.original.save(buf, "PNG"); return {"image_base64": base64.b64encode(buf.getvalue()).decode()}
+async def ori(sid: str):
+    b64 = await executor.run(sid, lambda s: s.get_original_base64())
+    if not b64: raise HTTPException(404, "Original não encontrada")
+    return {"image_base64": b64}
 
 # === NOVA ROTA DE SEGURANÇA: CONSUMIR CRÉDITOS ===
 @app.post("/api/consume-credit")
-def consume_credit(data: UserRequest):
-    if not supabase_admin: raise HTTPException(500, "Supabase Admin não configurado.")
-    
-    # 1. Buscar Perfil (Seguro)
-    res = supabase_admin.table('profiles').select('*').eq('id', data.user_id).single().execute()
-    profile = res.data
-    if not profile: raise HTTPException(404, "Perfil não encontrado.")
-
-    # 2. Verificar Saldo
-    has_free = not profile.get('free_generation_used', False)
-    credits = profile.get('credits', 0)
-
-    if not has_free and credits <= 0:
-        raise HTTPException(402, "Saldo insuficiente.") # 402 = Payment Required
-
-    # 3. Descontar
-    update_data = {}
-    if has_free:
-        print(f"🎁 {data.user_id} usando geração grátis.")
-        update_data = {'free_generation_used': True}
-    else:
-        print(f"💎 {data.user_id} gastando crédito.")
-        update_data = {'credits': credits - 1}
-
-    supabase_admin.table('profiles').update(update_data).eq('id', data.user_id).execute()
+async def consume_credit(data: UserRequest):
+    if not ledger: raise HTTPException(500, "Supabase Admin não configurado.")
+
+    # Verifica o saldo e desconta numa única operação atômica
+    try: result = await ledger.consume(data.user_id)
+    except httpx.HTTPError as e:
+        print(f"⚠️ Erro no ledger de créditos: {e}")
+        raise HTTPException(502, "Falha ao acessar os créditos.")
+
+    if result == CREDIT_NOT_FOUND: raise HTTPException(404, "Perfil não encontrado.")
+    if result == CREDIT_INSUFFICIENT: raise HTTPException(402, "Saldo insuficiente.") # 402 = Payment Required
+    if result == CREDIT_FREE: print(f"🎁 {data.user_id} usando geração grátis.")
+    else: print(f"💎 {data.user_id} gastando crédito.")
     return {"ok": True}
 
 # === PAGAMENTOS (STRIPE) ===
@@ -431,9 +1579,12 @@ async def webhook_received(request: Request):
         session = event['data']['object']
         user_id = session.get('client_reference_id')
         credits_to_add = int(session.get('metadata', {}).get('credits', 0))
-        if user_id and credits_to_add > 0 and supabase_admin:
-            print(f"💰 Pagamento confirmado: +{credits_to_add} para {user_id}")
-            res = supabase_admin.table('profiles').select('credits').eq('id', user_id).single().execute()
-            current = res.data['credits'] if res.data else 0
-            supabase_admin.table('profiles').update({'credits': current + credits_to_add}).eq('id', user_id).execute()
+        if user_id and credits_to_add > 0 and ledger:
+            # Reentregas do mesmo evento (mesmo id) não somam de novo
+            try: applied = await ledger.add(user_id, credits_to_add, event['id'])
+            except (httpx.HTTPError, LookupError) as e:
+                print(f"⚠️ Erro no ledger de créditos: {e}")
+                raise HTTPException(502, "Falha ao registrar os créditos.")  # não-2xx: o Stripe reenvia
+            if applied: print(f"💰 Pagamento confirmado: +{credits_to_add} para {user_id}")
+            else: print(f"↩️ Evento {event['id']} já aplicado, ignorando.")
     return {"status": "success"}
\ No newline at end of file
@@ -63,12 +63,11 @@ export async function mergeColors(fromIndex, toIndex) {
   eventBus.dispatchEvent(new Event('refresh'))
 }
 
-// NOVO: Buscar sugestões de agrupamento
-export async function getColorClusters() {
-  if (!sessionId.value) return []
+// Sugestões para vários limiares (ΔE) de uma vez: { threshold, clusters, levels: [{ threshold, clusters }] }
+export async function getColorClusterLevels() {
+  if (!sessionId.value) return { clusters: [], levels: [] }
   const res = await fetch(`${API_BASE}/api/clusters/${sessionId.value}`)
-  const data = await res.json()
-  return data.clusters || []
+  return await res.json()
 }
 
 // --- VISUALIZAÇÃO ---
@@ -92,6 +91,58 @@ export async function getGridImage() {
   return ""
 }
 
+// --- MATRIZ DE ÍNDICES (transporte compacto) ---
+// Resposta binária de /api/cells: cabeçalho de 28 bytes (magic, tipo, nº cores, W, H, versão, epoch),
+// paleta [índice, r, g, b] e o corpo: 0 = bruto, 1 = RLE [valor, comprimento u16], 2 = delta.
+let cellsCache = null
+
+export async function getCells() {
+  if (!sessionId.value) return null
+  const params = new URLSearchParams()
+  if (cellsCache && cellsCache.session === sessionId.value) {
+    params.set('since', cellsCache.version)
+    params.set('epoch', cellsCache.epoch)
+  }
+  const res = await fetch(`${API_BASE}/api/cells/${sessionId.value}?${params}`)
+  const buf = await res.arrayBuffer()
+  if (!buf.byteLength) return null
+
+  const view = new DataView(buf)
+  const kind = view.getUint8(4), count = view.getUint16(6, true)
+  const width = view.getUint32(8, true), height = view.getUint32(12, true)
+  const version = view.getUint32(16, true)
+  const epoch = new TextDecoder().decode(new Uint8Array(buf, 20, 8))
+  let off = 28
+  const palette = {}
+  for (let i = 0; i < count; i++, off += 4) {
+    palette[view.getUint8(off)] = [view.getUint8(off + 1), view.getUint8(off + 2), view.getUint8(off + 3)]
+  }
+
+  let cells
+  if (kind === 0) {
+    cells = new Uint8Array(buf, off, width * height).slice()
+  } else if (kind === 1) {
+    const runs = view.getUint32(off, true); off += 4
+    cells = new Uint8Array(width * height)
+    for (let i = 0, p = 0; i < runs; i++, off += 3) {
+      const n = view.getUint16(off + 1, true)
+      cells.fill(view.getUint8(off), p, p + n); p += n
+    }
+  } else {
+    const n = view.getUint32(off, true); off += 4
+    cells = cellsCache.cells
+    for (let i = 0; i < n; i++) cells[view.getUint32(off + 4 * i, true)] = view.getUint8(off + 4 * n + i)
+  }
+  cellsCache = { session: sessionId.value, version, epoch, width, height, palette, cells }
+  return cellsCache
+}
+
+// Bloco de 256x256 px da grade renderizada (para desenhar só a área visível)
+export const GRID_TILE = 256
+export function gridTileUrl(tx, ty) {
+  return `${API_BASE}/api/grid/tile/${sessionId.value}/${tx}/${ty}`
+}
+
 export async function updateParams(params) {
   await fetch(`${API_BASE}/api/params/${sessionId.value}`, {
     method: 'POST',
@@ -138,6 +189,22 @@ export async function replaceColorInRegion(x, y, w, h, fromIndex, toIndex) {
   eventBus.dispatchEvent(new Event('refresh'))
 }
 
+// Lote de edições (ex.: um traço inteiro do pincel) em uma única requisição.
+// ops: [{ op: 'paint', x, y, color_index }, { op: 'region', x, y, w, h, from_index, to_index },
+//       { op: 'merge', from_index, to_index }, { op: 'replace_color', index, new_hex }]
+// Retorna { cells: [[x, y], ...], palette_changed }
+export async function applyEdits(ops) {
+  if (!sessionId.value || !ops.length) return { cells: [], palette_changed: false }
+  const res = await fetch(`${API_BASE}/api/edits/${sessionId.value}`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ ops })
+  })
+  const data = await res.json()
+  eventBus.dispatchEvent(new Event('refresh'))
+  return data
+}
+
 export async function loadProjectFromSupabase(project) {
   try {
     // Verifica se a URL da imagem existe